@@ -0,0 +1,152 @@
+import threading
+import time
+
+import numpy as np
+
+try:
+    import Queue as queue
+except ImportError:
+    import queue
+
+# batches keras fit_generator keeps queued ahead of the training step (its max_q_size)
+KERAS_QUEUE_SIZE = 10
+
+
+class BatchPrefetcher(object):
+    '''
+    Generator of training batches assembled ahead of time by background threads, so that reading
+    and augmenting the samples overlaps with the model step. Up to depth batches wait in the queue,
+    their order between the workers is not kept. With no worker the batches are assembled on demand.
+
+    samples : iterator of the samples (view files or views), shared by the workers under a lock
+    make_batch : function of a list of batch_size samples returning the batch (inputs, targets)
+    ring : optional BatchRing the batches are copied into when queued. The workers finish out of order,
+           so they fill their own batches (see ThreadBuffers) and the ring is used in queue order.
+    '''
+
+    def __init__(self, samples, batch_size, make_batch, workers=4, depth=8, ring=None):
+        self.samples = samples
+        self.batch_size = batch_size
+        self.make_batch = make_batch
+        self.ring = ring
+        self.lock = threading.Lock()
+        self.put_lock = threading.Lock()
+        self.queue = queue.Queue(maxsize=depth)
+        self.stopped = threading.Event()
+        self.error = None
+        self.threads = [threading.Thread(target=self._work) for _ in range(workers)]
+        for t in self.threads:
+            t.daemon = True
+            t.start()
+
+    def _take(self):
+        with self.lock:
+            return [next(self.samples) for _ in range(self.batch_size)]
+
+    def _work(self):
+        while not self.stopped.is_set():
+            try:
+                batch = self.make_batch(self._take())
+            except Exception as e:
+                # handed to the consumer, StopIteration included
+                batch = e
+            with self.put_lock:
+                if self.ring is not None and not isinstance(batch, Exception):
+                    batch = self.ring.store(batch)
+                while not self.stopped.is_set():
+                    try:
+                        self.queue.put(batch, timeout=0.1)
+                        break
+                    except queue.Full:
+                        pass
+            if isinstance(batch, Exception):
+                return
+
+    def __iter__(self):
+        return self
+
+    def __next__(self):
+        if self.error is not None:
+            raise self.error
+        if not self.threads:
+            batch = self.make_batch(self._take())
+            return self.ring.store(batch) if self.ring is not None else batch
+        batch = self.queue.get()
+        if isinstance(batch, Exception):
+            self.error = batch
+            self.close()
+            raise batch
+        return batch
+
+    next = __next__
+
+    def close(self):
+        '''
+        stop the workers, the batches still queued are dropped
+        '''
+        self.stopped.set()
+
+
+def ring_size(workers=0, depth=0):
+    '''
+    batches alive at once when a generator feeds fit_generator: the keras queue, the batch trained on
+    and the one being filled, plus the batches queued and held by the workers of a BatchPrefetcher
+    '''
+    return KERAS_QUEUE_SIZE + 2 + depth + workers
+
+
+class BatchRing(object):
+    '''
+    Ring of preallocated float32 batches, filled in place instead of allocating a new batch every step
+    (keras would also convert a float64 batch to float32). A batch is handed out again size batches
+    later, size must exceed the number of batches alive at once (see ring_size).
+
+    shapes : shape of each array of a batch, e.g. [inputs shape, targets shape]
+    '''
+
+    def __init__(self, shapes, size):
+        self.batches = [tuple(np.zeros(shape, dtype=np.float32) for shape in shapes) for _ in range(size)]
+        self.lock = threading.Lock()
+        self.ind = 0
+
+    def take(self):
+        with self.lock:
+            batch = self.batches[self.ind]
+            self.ind = (self.ind + 1) % len(self.batches)
+        return batch
+
+    def store(self, batch):
+        '''
+        copy batch into the next batch of the ring
+        '''
+        out = self.take()
+        for dst, src in zip(out, batch):
+            dst[...] = src
+        return out
+
+
+class ThreadBuffers(object):
+    '''
+    One preallocated float32 batch per thread, for the workers of a BatchPrefetcher to fill in place
+    before the batch is copied into the ring. Same take() as BatchRing.
+    '''
+
+    def __init__(self, shapes):
+        self.shapes = shapes
+        self.local = threading.local()
+
+    def take(self):
+        if not hasattr(self.local, 'batch'):
+            self.local.batch = tuple(np.zeros(shape, dtype=np.float32) for shape in self.shapes)
+        return self.local.batch
+
+
+def input_throughput(batches, n_batches=20):
+    '''
+    samples per second delivered by a batch generator alone, without the model step
+    '''
+    start = time.time()
+    n_sample = 0
+    for _ in range(n_batches):
+        n_sample += len(next(batches)[0])
+    return n_sample / (time.time() - start)
@@ -0,0 +1,25 @@
+import numpy as np
+
+
+def box_bounds_mask(points, boxes, margin=1e-3):
+    '''
+    cheap pre-filter for the exact point in box tests
+
+    points : numpy array of shape N*D, D>=2 (the height is tested too when D>=3)
+    boxes : corners of the boxes, numpy array of shape B*K*2 or B*K*3
+    margin : padding of the xy bounds, so that rounding in the exact tests cannot
+             accept a point the bounds have rejected
+
+    return : N*B mask of the points within the axis aligned xy bounds and the open
+             z range of each box, a superset of the points inside the boxes
+    '''
+    low = np.min(boxes[:, :, :2], axis=1) - margin
+    high = np.max(boxes[:, :, :2], axis=1) + margin
+
+    xy = points[:, np.newaxis, :2]
+    mask = np.all((xy >= low) & (xy <= high), axis=2)
+
+    if boxes.shape[2] > 2 and points.shape[1] > 2:
+        z = points[:, [2]]
+        mask &= (z > np.min(boxes[:, :, 2], axis=1)) & (z < np.max(boxes[:, :, 2], axis=1))
+    return mask
@@ -1,3 +1,4 @@
+import argparse
 import numpy as np
 import tensorflow as tf
 import keras
@@ -10,6 +11,7 @@ from sklearn.cluster import DBSCAN
 from keras.optimizers import Adam
 
 from cluster_classify_model import cluster_classify_model
+from quantized_model import TFLiteModel
 from cluster_classify_util import *
 from cluster_classify_train import *
 from test_on_udacity_data import *
@@ -17,6 +19,17 @@ from test_on_udacity_data import *
 from keras.utils.generic_utils import get_custom_objects
 get_custom_objects().update({"my_loss": my_loss})
 
+BACKENDS = ('keras', 'tflite')
+
+
+def load_classifier(model_path, backend='keras'):
+    '''
+    backend : 'keras' for the .h5 model, 'tflite' for its quantized export next to it (see quantized_model.py)
+    '''
+    assert backend in BACKENDS, "unknown inference backend"
+    if backend == 'tflite':
+        return TFLiteModel(os.path.splitext(model_path)[0] + '.tflite')
+    return load_model(model_path)
 
 def predict(model,lidar, thresh=0.5):
     lidar, labels = cluster(lidar)
@@ -72,13 +85,17 @@ def predict_test_set(model, test_dir, pred_dir):
 
 
 if __name__ == "__main__":
+	parser = argparse.ArgumentParser(description='predict the boxes of the cars of the test clusters')
+	parser.add_argument('--backend', default='keras', choices=BACKENDS,
+						help="'tflite' runs the quantized export of the model (see quantized_model.py)")
+	args = parser.parse_args()
 	
 	#lidar = np.load('./data/training_didi_data/car_train_edited/bmw_sitting_still/lidar/lidar_100.npy')
 	#gtbox = np.load('./data/training_didi_data/car_train_gt_box_edited/bmw_sitting_still/gt_boxes3d/gt_boxes3d_100.npy')
 	#viz_mayavi_with_labels(lidar, gtbox)
 
 
-	model = load_model('./saved_model/last_model.h5') 
+	model = load_classifier('./saved_model/last_model.h5', args.backend)
 	#boxes = predict(model, lidar)
 
 	#viz_mayavi_with_labels(lidar, boxes)
@@ -11,6 +11,7 @@ from keras.callbacks import ModelCheckpoint, CSVLogger
 
 from cluster_classify_model import cluster_classify_model
 from cluster_classify_util import *
+from batch_prefetch import BatchRing, ring_size, input_throughput
 
 
 def data_generator(list_of_cars, list_of_not_cars, list_of_gtboxes):
@@ -64,12 +65,12 @@ def data_generator(list_of_cars, list_of_not_cars, list_of_gtboxes):
 
 def train_batch_generator(list_of_cars, list_of_not_cars, list_of_gtboxes, batch_size = 32, data_augmentation = True, width = 64, height = 64, nb_channels = 2, nb_features = 7):
 
+    ring = BatchRing([(batch_size, height, width, nb_channels), (batch_size, nb_features)], ring_size())
     ind = 0
     for lidar_file, gtbox_file, is_car in data_generator(list_of_cars, list_of_not_cars, list_of_gtboxes):
         
         if ind == 0:
-            batch_sample = np.zeros((batch_size, height, width, nb_channels))
-            batch_label = np.zeros((batch_size, nb_features))
+            batch_sample, batch_label = ring.take()
 
         
         if is_car == 1:
@@ -102,6 +103,8 @@ def train_batch_generator(list_of_cars, list_of_not_cars, list_of_gtboxes, batch
             img, _ = discretize(lidar)
 
             batch_sample[ind] = img
+            # the buffer still holds the label of an older batch
+            batch_label[ind] = 0
 
         ind += 1
         if ind == batch_size:
@@ -187,7 +190,10 @@ if __name__ == '__main__':
 	print('Start training - batch_size : {0} - num_frame : {1} - steps_per_epoch : {2}'.format(batch_size,num_frame,steps_per_epoch))
 	start = time.time()
 
-	model.fit_generator(generator=train_batch_generator(list_of_cars, list_of_not_cars, list_of_gtboxes, batch_size = batch_size, data_augmentation = augmentation),
+	batches = train_batch_generator(list_of_cars, list_of_not_cars, list_of_gtboxes, batch_size = batch_size, data_augmentation = augmentation)
+	print('Input pipeline: {0:.1f} samples/s'.format(input_throughput(batches)))
+
+	model.fit_generator(generator=batches,
                        steps_per_epoch=steps_per_epoch,
                        epochs=epochs,
                        callbacks=[checkpointer])#, logger])
@@ -1,5 +1,6 @@
 import numpy as np
 from sklearn.cluster import DBSCAN
+from scipy import ndimage
 import time
 import os
 
@@ -10,6 +11,12 @@ MAX_Z = 0.5
 
 SCALE = 1.2
 
+# grid clustering parameters of the c++ point filter (object_tracker/include/object_tracker/define.h)
+GROUND_Z = -1.3
+GROUND_EPS = 0.1
+CAR_ROI_RADIUS = 35.
+CAR_RESOLUTION = 0.8
+
 def scale_to_255(a, min, max, dtype=np.uint8):
     """ Scales an array of values from specified min, max range to 0-255
         Optionally specify the data type of the output (default is uint8)
@@ -121,16 +128,49 @@ def rotation_cluster(theta, lidar, flip = 0):
 	else:
 		return np.array([flip_rotation(theta, lidar[i]) for i in range(len(lidar)) ])
 
+def grid_cluster(lidar, resolution = CAR_RESOLUTION, roi_radius = CAR_ROI_RADIUS, min_top = GROUND_Z + 2*GROUND_EPS):
+    '''
+    numpy version of the ClusterBuilder of the c++ point filter: points are binned into an xy grid
+    of the given resolution around the origin, and the cells whose highest point is above min_top
+    are grouped into clusters by 8-connectivity
+    
+    return : cluster label of every point, -1 for points out of the roi or in a cell that is too low
+    '''
+    iradius = int(roi_radius / resolution + 0.5)
+    iwidth = int(2 * roi_radius / resolution + 0.5)
+    labels = -np.ones(len(lidar), dtype=int)
+    
+    # cell indices are truncated like the c++ int casts
+    rx = np.trunc(lidar[:,0] / resolution + 0.5).astype(int)
+    ry = np.trunc(lidar[:,1] / resolution + 0.5).astype(int)
+    ix = np.trunc((lidar[:,0] + roi_radius) / resolution + 0.5).astype(int)
+    iy = np.trunc((lidar[:,1] + roi_radius) / resolution + 0.5).astype(int)
+    in_roi = (rx*rx + ry*ry <= iradius*iradius) * (ix >= 0) * (ix < iwidth) * (iy >= 0) * (iy < iwidth)
+    cell = ix[in_roi] * iwidth + iy[in_roi]
+    
+    top = -np.inf * np.ones(iwidth * iwidth)
+    np.maximum.at(top, cell, lidar[in_roi,2])
+    occupied = (top >= min_top).reshape(iwidth, iwidth)
+    
+    # clusters are numbered in the scan order of the c++ region growing
+    cell_labels, _ = ndimage.label(occupied, structure = np.ones((3,3)))
+    labels[in_roi] = cell_labels.reshape(-1)[cell] - 1
+    return labels
+
+
 def cluster(lidar, min_d = 2, min_z = -1.35, max_z = 0.5, max_xrange = 6,
             max_yrange = 6, min_xrange = 0.5, min_yrange = 0.5,  
-            min_zrange = 0.2, min_points = 15, z_scale = 1.,eps = 0.8, min_samples = 1):
+            min_zrange = 0.2, min_points = 15, z_scale = 1.,eps = 0.8, min_samples = 1,
+            method = 'dbscan'):
     '''
     min_z : remove points whose z <= min_z (ground removing)
     min_d : remove points within distance of min_d
     z_scale: scale z coordinate before clustering
     eps, min_smaples: parameters of DBSCAN 
     max_xrange, min_xrange, max_yrange, min_yrange, min_zrange : filter out x,y,z range of clusters 
+    method : 'dbscan' or 'grid' (grid_cluster, as the c++ point filter; z_scale, eps and min_samples are ignored)
     '''
+    assert method in ('dbscan', 'grid'), "unknown clustering method"
 
 
     # remove ground points
@@ -138,40 +178,40 @@ def cluster(lidar, min_d = 2, min_z = -1.35, max_z = 0.5, max_xrange = 6,
     # remove near points (can improve)
     d = np.sqrt(np.square(lidar[:,0]) + np.square(lidar[:,1]))
     lidar = lidar[d>=min_d]
-    # scale z
-    lidar1 = np.copy(lidar)
-    lidar1[:,2] = (lidar1[:,2]+min_z)/z_scale
-    # Clustering
-    db = DBSCAN(eps=eps, min_samples=min_samples).fit(lidar1)
-    labels = db.labels_
+    if method == 'grid':
+        # Clustering, dropping the points left out of any cluster
+        labels = grid_cluster(lidar)
+        lidar = lidar[labels >= 0]
+        labels = labels[labels >= 0]
+    else:
+        # scale z
+        lidar1 = np.copy(lidar)
+        lidar1[:,2] = (lidar1[:,2]+min_z)/z_scale
+        # Clustering
+        db = DBSCAN(eps=eps, min_samples=min_samples).fit(lidar1)
+        labels = db.labels_
+    if len(labels) == 0:
+        # nothing left to cluster (e.g. a frame of ground points only)
+        return lidar, labels
     # filter max_z, max_xrange = 3, max_yrange, min_zrange 
-    label_set = list(set(labels))
-    cluster_height = np.zeros(len(label_set))
-    cluster_zrange = np.zeros(len(label_set))
-    cluster_xrange = np.zeros(len(label_set))
-    cluster_yrange = np.zeros(len(label_set))
-    n_points = np.zeros(len(label_set))
-    for i in range(len(label_set)):
-        z_cluster = lidar[:,2][labels == label_set[i]]
-        cluster_height[i] = np.max(z_cluster)
-        cluster_zrange[i] = cluster_height[i] - np.min(z_cluster)
-        
-        x_cluster = lidar[:,0][labels == label_set[i]]
-        cluster_xrange[i] = np.max(x_cluster) - np.min(x_cluster)
-        
-        y_cluster = lidar[:,1][labels == label_set[i]]
-        cluster_yrange[i] = np.max(y_cluster) - np.min(y_cluster)
-        
-        n_points[i] = np.sum(labels == label_set[i])
-        
-    features = np.array([[cluster_height[labels[i]], cluster_xrange[labels[i]], cluster_yrange[labels[i]], 
-                          cluster_zrange[labels[i]], n_points[labels[i]] ]  for i in range(len(labels))])
+    # per cluster statistics in one pass: points are sorted by label and reduced per label
+    label_set, inverse, n_points = np.unique(labels, return_inverse=True, return_counts=True)
+    order = np.argsort(inverse, kind='mergesort')
+    starts = np.concatenate(([0], np.cumsum(n_points)[:-1]))
+    cluster_min = np.minimum.reduceat(lidar[order,:3], starts)
+    cluster_max = np.maximum.reduceat(lidar[order,:3], starts)
+    
+    cluster_height = cluster_max[:,2].astype(np.float64)
+    cluster_zrange = cluster_height - cluster_min[:,2]
+    cluster_xrange = (cluster_max[:,0] - cluster_min[:,0]).astype(np.float64)
+    cluster_yrange = (cluster_max[:,1] - cluster_min[:,1]).astype(np.float64)
     
-    index = (features[:,0]<=max_z)*(features[:,1]<=max_xrange)*(features[:,2]<=max_yrange)*(features[:,3]>=min_zrange)*(features[:,4]>=min_points)
+    keep = (cluster_height<=max_z)*(cluster_xrange<=max_xrange)*(cluster_yrange<=max_yrange)*(cluster_zrange>=min_zrange)*(n_points>=min_points)
     if min_xrange != None:
-        index = index*(features[:,1]>= min_xrange)
+        keep = keep*(cluster_xrange>= min_xrange)
     if min_yrange != None:
-        index = index*(features[:,2]>= min_yrange)
+        keep = keep*(cluster_yrange>= min_yrange)
+    index = keep[inverse]
     return lidar[index], labels[index]
 
 
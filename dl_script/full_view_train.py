@@ -4,6 +4,7 @@ import keras
 import os
 import time
 import pickle
+from functools import partial
 
 from keras.optimizers import Adam
 from keras.models import load_model
@@ -12,6 +13,9 @@ from keras.callbacks import ModelCheckpoint, CSVLogger
 
 from full_view_model import fcn_model
 from util_func import *
+from sparse_view import load_view, unique_views
+from view_shards import ViewShards, stale_views
+from batch_prefetch import BatchPrefetcher, BatchRing, ThreadBuffers, ring_size, input_throughput
 
 
 def list_of_data(data_dir):
@@ -22,7 +26,8 @@ def list_of_data(data_dir):
 			view = os.path.join(path,f)
 			list_of_view.append(view)
 			
-	return list_of_view
+	# a view converted again in the other format (dense or sparse) is listed once
+	return unique_views(list_of_view)
 
 
 
@@ -55,41 +60,120 @@ def data_generator(list_of_view):
 				if ind >= n_sample:
 					next_epoch = True  
 
-def train_batch_generator(list_of_view, batch_size = 32, data_augmentation = True, input_width = 328, output_width = 320, height = 16):
+# channels of the training views: d, z and the box encoding (objectness, corners 0 and 6 relative
+# to the point in its own frame, phi). The encoding is the same whatever the direction of the point,
+# so rotating a view is a circular shift of its columns, mirroring it negates y of the corners
+# and swaps the sides of the boxes
+OBJECT_CHANNEL = 2
+CORNER_Y_CHANNELS = (4, 7)
+PHI_CHANNEL = 9
 
+def circular_crop(view, start, output_width, circle_width):
+	'''
+	input: view covering 360 degrees over circle_width columns, optionally padded on both sides
+		   start: position on the circle of the first column to read
+	output: one or two (output columns, view columns) slices covering output_width columns,
+			two when the crop wraps around the circle beyond the padding
+	'''
+	pad = int((view.shape[1] - circle_width)/2)
+	start = start % circle_width
+	if start + output_width > circle_width + pad:
+		# start from the left padding instead when it holds the first column
+		if start - circle_width >= -pad:
+			start -= circle_width
+		else:
+			n = circle_width - start
+			return [(slice(0, n), slice(pad + start, pad + circle_width)),
+					(slice(n, output_width), slice(pad, pad + output_width - n))]
+	return [(slice(0, output_width), slice(pad + start, pad + start + output_width))]
+
+def flip_labels(batch_label):
+	'''
+	fix the box encoding (B*H*W*8, in place) of a batch of views mirrored left to right
+	'''
+	for c in CORNER_Y_CHANNELS:
+		batch_label[..., c - 2] *= -1
+	# phi of the pixels of a box (objectness 1) becomes pi/2 - phi, the other pixels stay 0
+	phi = batch_label[..., PHI_CHANNEL - 2]
+	phi *= -1
+	phi += (np.pi/2) * batch_label[..., OBJECT_CHANNEL - 2]
+
+def make_batch(views, buffers = None, data_augmentation = True, input_width = 328, output_width = 320, height = 16,
+				circle_width = 320, max_shift = 4, flip = False):
+	'''
+	input: list of views (view files or arrays) of input_width columns, panoramas of circle_width columns
+		   padded on both sides, optional BatchRing or ThreadBuffers of batches of len(views) views to fill in place
+	data_augmentation: rotate every view by a random shift of up to max_shift columns (any rotation
+		   when None) and mirror half of them when flip
+	output: batch of samples (d, z channels) and labels of output_width columns
+	'''
 	offset_range = input_width - output_width + 1
 	offset = int(offset_range/2)
-	ind = 0
-	for view_file in data_generator(list_of_view):
-		view = np.load(view_file)
-		
-		if ind == 0:
-			batch_sample = np.zeros((batch_size, height, output_width, 2))
-			batch_label = np.zeros((batch_size, height, output_width, 8))
-
-		if data_augmentation:
-			# Randomly flip the frame
-			#flip = np.random.randint(2)
-			#if flip:
-			#	view = view[:,::-1,:]
-			#	view[:,:,-1] = np.pi/2 - view[:,:,-1]
-			#flip = 1
-			offset = np.random.randint(offset_range)
-			#offset = 0
-			#lidar, gt_box = augmentation(offset, flip, lidar, gt_box)
-
+	pad = int((input_width - circle_width)/2)
+	# column 0 of a panorama only holds the points at exactly -180 degrees (see PanoramaGrid.bin), the
+	# 360 degrees are columns 1 to circle_width-1: only those are rotated and mirrored, column 0 stays first
+	n_col = circle_width - 1
 
-		view = view[:,offset:offset+output_width,:]
-
-		batch_sample[ind] = view[:,:,:2]
-		batch_label[ind] = view[:,:,2:]
-
-		ind += 1
-
-		if ind == batch_size:
-			yield batch_sample, batch_label
-
-			ind = 0
+	if buffers is not None:
+		batch_sample, batch_label = buffers.take()
+	else:
+		batch_sample = np.zeros((len(views), height, output_width, 2), dtype=np.float32)
+		batch_label = np.zeros((len(views), height, output_width, 8), dtype=np.float32)
+
+	# draw the augmentation of the whole batch at once
+	shifts = np.zeros(len(views), dtype=int)
+	n_flip = 0
+	if data_augmentation:
+		if max_shift is None:
+			shifts = np.random.randint(n_col, size=len(views))
+		else:
+			shifts = np.random.randint(-max_shift, max_shift + 1, size=len(views))
+		if flip:
+			# the views come in random order, mirroring the first n_flip of them is a random choice
+			# and keeps the mirrored labels contiguous
+			n_flip = np.random.binomial(len(views), 0.5)
+
+	for ind, view_file in enumerate(views):
+		# dense .npy or sparse .npz views, or views of a ViewShards read in place
+		view = view_file if isinstance(view_file, np.ndarray) else load_view(view_file)
+
+		batch_sample[ind,:,0] = view[:,offset,:2]
+		batch_label[ind,:,0] = view[:,offset,2:]
+
+		# the circle without its padding, mirrored with a negative stride
+		circle = view[:,pad + 1:pad + circle_width,:]
+		if ind < n_flip:
+			circle = circle[:,::-1,:]
+
+		sample = batch_sample[ind,:,1:]
+		label = batch_label[ind,:,1:]
+		for out_cols, view_cols in circular_crop(circle, offset - pad + shifts[ind], output_width - 1, n_col):
+			sample[:,out_cols] = circle[:,view_cols,:2]
+			label[:,out_cols] = circle[:,view_cols,2:]
+
+	if n_flip > 0:
+		flip_labels(batch_label[:n_flip])
+
+	return batch_sample, batch_label
+
+def train_batch_generator(list_of_view, batch_size = 32, data_augmentation = True, input_width = 328, output_width = 320, height = 16,
+							workers = 0, queue_depth = 8):
+	'''
+	data_augmentation : random shift of the views by up to 4 columns, with the defaults of make_batch
+			  (mirroring and any rotation are opt-in there)
+	workers : threads assembling the batches in the background, up to queue_depth batches ahead
+			  of the training step. 0 assembles them on the training thread
+	'''
+	shapes = [(batch_size, height, output_width, 2), (batch_size, height, output_width, 8)]
+	ring = BatchRing(shapes, ring_size(workers, queue_depth))
+	if workers > 0:
+		# the workers finish out of order: each fills its own batch, copied into the ring when queued
+		batch = partial(make_batch, buffers = ThreadBuffers(shapes), data_augmentation = data_augmentation,
+						input_width = input_width, output_width = output_width, height = height)
+		return BatchPrefetcher(data_generator(list_of_view), batch_size, batch, workers, queue_depth, ring)
+	batch = partial(make_batch, buffers = ring, data_augmentation = data_augmentation, input_width = input_width,
+					output_width = output_width, height = height)
+	return BatchPrefetcher(data_generator(list_of_view), batch_size, batch, workers, queue_depth)
 
 def my_loss(y_true, y_pred):
 
@@ -123,8 +207,17 @@ if __name__ == '__main__':
 	# mean_tensor, std_tensor = get_mean_std_tensor(depth_mean, height_mean, depth_var, height_var, input_shape = (64,256,2))
 
 	data_dir = './data/training_didi_data/car_train_edited/'
+	shard_dir = './data/training_didi_data/car_train_shards/'
 
 	list_of_view = list_of_data(data_dir)
+	# the views packed by view_shards.py are read from their shards, unless converted again since
+	if os.path.exists(shard_dir):
+		stale = stale_views(shard_dir, list_of_view)
+		if len(stale) == 0:
+			list_of_view = ViewShards(shard_dir)
+		else:
+			print('{0} views changed since {1} was packed, reading the view files (run view_shards.py again)'.format(
+				len(stale), shard_dir))
 	print('len(list_of_view): ', len(list_of_view))
 
 
@@ -136,6 +229,8 @@ if __name__ == '__main__':
 	batch_size = 1
 	epochs = 100
 	augmentation = True
+	workers = 4 # threads loading the views while the model trains
+	queue_depth = 8
 	
 	num_frame = len(list_of_view)
 	steps_per_epoch = int(num_frame/batch_size)
@@ -167,7 +262,11 @@ if __name__ == '__main__':
 	print('Start training - batch_size : {0} - num_frame : {1} - steps_per_epoch : {2}'.format(batch_size,num_frame,steps_per_epoch))
 	start = time.time()
 
-	model.fit_generator(generator=train_batch_generator(list_of_view, batch_size = batch_size, data_augmentation = augmentation),
+	batches = train_batch_generator(list_of_view, batch_size = batch_size, data_augmentation = augmentation,
+									workers = workers, queue_depth = queue_depth)
+	print('Input pipeline: {0:.1f} samples/s'.format(input_throughput(batches)))
+
+	model.fit_generator(generator=batches,
                        steps_per_epoch=steps_per_epoch,
                        epochs=epochs,
                        callbacks=[checkpointer])#, logger])
@@ -0,0 +1,115 @@
+import numpy as np
+
+
+class PanoramaGrid(object):
+    '''
+    Geometry of a cylindrical projection (panorama view) of lidar points.
+
+    ver_fov : angle range of vertical projection in degree
+    hor_fov : angle range of horizontal projection in degree
+    v_res : vertical resolution
+    h_res : horizontal resolution
+    shape : (height, width) of the view. When None it is derived from the field of view
+            and the resolution, otherwise points binned outside of it are dropped
+            (used to fit a view to the fixed input size of a model)
+    '''
+
+    def __init__(self, ver_fov, hor_fov, v_res, h_res, shape=None):
+        self.ver_fov = ver_fov
+        self.hor_fov = hor_fov
+        self.v_res = v_res
+        self.h_res = h_res
+
+        if shape is None:
+            shape = (int(np.ceil((ver_fov[1] - ver_fov[0]) / v_res)) + 1,
+                     int(np.ceil((hor_fov[1] - hor_fov[0]) / h_res)) + 1)
+        self.height, self.width = shape
+        self.y_max = self.height - 1
+        self.x_max = self.width - 1
+
+    def polar(self, lidar):
+        '''
+        lidar: a numpy array of shape N*D, D>=3
+        return : horizontal distance d, azimuth theta and elevation phi (in rad) of every point
+        '''
+        x = lidar[:, 0]
+        y = lidar[:, 1]
+        z = lidar[:, 2]
+        d = np.sqrt(np.square(x) + np.square(y))
+
+        theta = np.arctan2(-y, x)
+        phi = -np.arctan2(z, d)
+        return d, theta, phi
+
+    def bin(self, theta, phi):
+        '''
+        theta, phi : azimuth and elevation of points in rad
+        return : column x_view, row y_view of every point and the mask of points inside the view
+        '''
+        x_view = np.int16(np.ceil((theta * 180 / np.pi - self.hor_fov[0]) / self.h_res))
+        y_view = np.int16(np.ceil((phi * 180 / np.pi + self.ver_fov[1]) / self.v_res))
+
+        indices = np.logical_and(np.logical_and(x_view >= 0, x_view <= self.x_max),
+                                 np.logical_and(y_view >= 0, y_view <= self.y_max))
+        return x_view, y_view, indices
+
+    def project(self, lidar):
+        '''
+        lidar: a numpy array of shape N*D, D>=3
+        return : x_view, y_view, indices (see bin) followed by d, theta, phi (see polar)
+        '''
+        d, theta, phi = self.polar(lidar)
+        x_view, y_view, indices = self.bin(theta, phi)
+        return x_view, y_view, indices, d, theta, phi
+
+    def empty_view(self, nb_channels):
+        return np.zeros([self.height, self.width, nb_channels], dtype=np.float32)
+
+    def scatter(self, view, x_view, y_view, indices, values):
+        '''
+        write the per-point values (N*C) of the points inside the view into their pixels,
+        the last point wins when several points fall into the same pixel
+        '''
+        view[y_view[indices], x_view[indices]] = values[indices]
+        return view
+
+
+_grids = {}
+
+
+def panorama_grid(ver_fov, hor_fov, v_res, h_res, shape=None):
+    '''
+    return the PanoramaGrid of the given parameters, built once and shared by every caller
+    '''
+    key = (tuple(ver_fov), tuple(hor_fov), v_res, h_res, None if shape is None else tuple(shape))
+    if key not in _grids:
+        _grids[key] = PanoramaGrid(ver_fov, hor_fov, v_res, h_res, shape)
+    return _grids[key]
+
+
+def project_segments(lidar, hor_fov_arr, ver_fov, v_res, h_res, shape, out=None):
+    '''
+    cylindrical projection of lidar into several horizontal segments at once,
+    the polar coordinates are computed a single time and only the binning is done per segment
+
+    lidar: a numpy array of shape N*D, D>=3
+    hor_fov_arr : list of horizontal angle ranges in degree, one per segment
+    shape : (height, width) of every segment view
+    out : optional float32 buffer of shape (num_segments, height, width, 6) to fill in place
+
+    return : views of shape (num_segments, height, width, 6) holding x, y, z, theta, phi, d
+    '''
+    grids = [panorama_grid(ver_fov, hor_fov, v_res, h_res, shape) for hor_fov in hor_fov_arr]
+
+    if out is None:
+        out = np.zeros([len(grids), grids[0].height, grids[0].width, 6], dtype=np.float32)
+    else:
+        out.fill(0)
+
+    d, theta, phi = grids[0].polar(lidar)
+    coord = np.stack((lidar[:, 0], lidar[:, 1], lidar[:, 2], theta, phi, d), axis=-1)
+
+    for view, grid in zip(out, grids):
+        x_view, y_view, indices = grid.bin(theta, phi)
+        grid.scatter(view, x_view, y_view, indices, coord)
+    return out
@@ -0,0 +1,167 @@
+#!/usr/bin/env python
+import argparse
+import glob
+import os
+import time
+
+import numpy as np
+import tensorflow as tf
+
+from sparse_view import load_view
+
+MODES = ('int8', 'float16')
+MAX_CALIBRATION_INPUTS = 200
+
+
+class TFLiteModel(object):
+    '''
+    Quantized model written by quantize(), run by the tflite interpreter on CPU.
+    predict() behaves as the one of the keras model it was converted from, the inputs and
+    outputs stay float32 whatever the mode. Use one instance per thread.
+    '''
+
+    def __init__(self, path):
+        self.interpreter = tf.lite.Interpreter(model_path=path)
+        self.interpreter.allocate_tensors()
+        self.input_index = self.interpreter.get_input_details()[0]['index']
+        self.output_index = self.interpreter.get_output_details()[0]['index']
+
+    def predict(self, x, batch_size=None):
+        # the converted graph takes one input at a time
+        x = np.asarray(x, dtype=np.float32)
+        outputs = []
+        for sample in x:
+            self.interpreter.set_tensor(self.input_index, sample[np.newaxis])
+            self.interpreter.invoke()
+            outputs.append(self.interpreter.get_tensor(self.output_index)[0])
+        return np.stack(outputs)
+
+
+def load_inputs(view_dir, input_shape, limit=MAX_CALIBRATION_INPUTS):
+    '''
+    model inputs from the dense (.npy) or sparse (.npz) views of view_dir. Views of 6 channels
+    (x, y, z, theta, phi, d) fed to dl_tracker are reduced to the (d, z) channels of the full view
+    model and cropped, training views of 10 channels (d, z, box encoding) keep (d, z) and are
+    cropped around their center as in training
+    '''
+    inputs = []
+    for f in sorted(glob.glob(os.path.join(view_dir, '*.np[yz]')))[:limit]:
+        view = load_view(f)
+        if input_shape[-1] == 2 and view.shape[-1] == 6:
+            view = view[:, :, [5, 2]]
+        elif input_shape[-1] == 2 and view.shape[-1] == 10:
+            offset = (view.shape[1] - input_shape[1]) // 2
+            view = view[:, offset:, :2]
+        inputs.append(view[:input_shape[0], :input_shape[1]].astype(np.float32))
+    assert len(inputs) > 0, "no .npy or .npz view in {0}".format(view_dir)
+    return inputs
+
+
+def load_cluster_inputs(cluster_dir, limit=MAX_CALIBRATION_INPUTS):
+    '''
+    inputs of the cluster classifier: the clusters (.npy, N*3 points) of cluster_dir discretized
+    to images as in cluster_classify_train
+    '''
+    from cluster_classify_util import discretize
+
+    inputs = []
+    for f in sorted(glob.glob(os.path.join(cluster_dir, '*.npy')))[:limit]:
+        img, _ = discretize(np.load(f))
+        inputs.append(img.astype(np.float32))
+    assert len(inputs) > 0, "no .npy cluster in {0}".format(cluster_dir)
+    return inputs
+
+
+def quantize(converter, mode, calibration_inputs=None):
+    '''
+    converter : tf.lite converter of the float model
+    mode : 'float16' halves the weights, 'int8' quantizes weights and activations with
+           ranges calibrated on calibration_inputs (list of single model inputs)
+    return : the serialized tflite model
+    '''
+    assert mode in MODES, "unknown quantization mode"
+    converter.optimizations = [tf.lite.Optimize.DEFAULT]
+    if mode == 'float16':
+        converter.target_spec.supported_types = [tf.float16]
+    else:
+        assert calibration_inputs, "int8 quantization needs calibration inputs"
+
+        def representative_dataset():
+            for x in calibration_inputs:
+                yield [x[np.newaxis]]
+        converter.representative_dataset = representative_dataset
+    return converter.convert()
+
+
+def segmentation_drift(reference, quantized, inputs, thres=0.5):
+    '''
+    drift of the segmentation channel (channel 0, the car probability of the cluster classifier)
+    of the quantized model from the reference
+
+    return : max and mean absolute difference of the channel, and the intersection over union
+             of the pixels above thres of both models
+    '''
+    max_diff = 0.
+    sum_diff = 0.
+    inter = 0
+    union = 0
+    for x in inputs:
+        seg_ref = reference.predict(x[np.newaxis])[..., 0]
+        seg_q = quantized.predict(x[np.newaxis])[..., 0]
+        diff = np.abs(seg_ref - seg_q)
+        max_diff = max(max_diff, float(diff.max()))
+        sum_diff += float(diff.mean())
+        inter += np.count_nonzero((seg_ref > thres) & (seg_q > thres))
+        union += np.count_nonzero((seg_ref > thres) | (seg_q > thres))
+    iou = float(inter) / union if union > 0 else 1.
+    return max_diff, sum_diff / len(inputs), iou
+
+
+def mean_predict_time(model, inputs):
+    model.predict(inputs[0][np.newaxis])
+    start = time.time()
+    for x in inputs:
+        model.predict(x[np.newaxis])
+    return (time.time() - start) / len(inputs)
+
+
+if __name__ == '__main__':
+    parser = argparse.ArgumentParser(description='quantize a keras model (full view model or cluster '
+                                                 'classifier) to tflite and report its drift')
+    parser.add_argument('model', help='trained keras .h5 model')
+    parser.add_argument('output', help='.tflite model to write')
+    parser.add_argument('views', help='directory of saved .npy or .npz views (.npy clusters with --classifier), '
+                                      'used for calibration and for the drift')
+    parser.add_argument('--classifier', action='store_true', help='the model is the cluster classifier')
+    parser.add_argument('--mode', default='int8', choices=MODES)
+    parser.add_argument('--thres', type=float, default=0.5, help='segmentation threshold of the drift report')
+    args = parser.parse_args()
+
+    from keras.models import load_model
+    if args.classifier:
+        from cluster_classify_train import my_loss
+    else:
+        from full_view_train import my_loss
+
+    custom_objects = {'my_loss': my_loss}
+    model = load_model(args.model, custom_objects=custom_objects)
+    if args.classifier:
+        inputs = load_cluster_inputs(args.views)
+    else:
+        inputs = load_inputs(args.views, model.input_shape[1:])
+
+    if hasattr(tf.lite.TFLiteConverter, 'from_keras_model_file'):
+        converter = tf.lite.TFLiteConverter.from_keras_model_file(args.model, custom_objects=custom_objects)
+    else:
+        # tensorflow 2 converts the loaded model
+        converter = tf.lite.TFLiteConverter.from_keras_model(model)
+    with open(args.output, 'wb') as f:
+        f.write(quantize(converter, args.mode, inputs))
+    quantized = TFLiteModel(args.output)
+
+    max_diff, mean_diff, iou = segmentation_drift(model, quantized, inputs, args.thres)
+    print('{0} model: {1:.0f} KB'.format(args.mode, os.path.getsize(args.output) / 1024.))
+    print('segmentation drift on {0} inputs: max {1:.4f}, mean {2:.5f}, iou above {3}: {4:.4f}'.format(
+        len(inputs), max_diff, mean_diff, args.thres, iou))
+    print('predict time: keras {0:.1f} ms, {1} {2:.1f} ms'.format(
+        mean_predict_time(model, inputs) * 1000., args.mode, mean_predict_time(quantized, inputs) * 1000.))
@@ -12,6 +12,7 @@ from keras.callbacks import ModelCheckpoint, CSVLogger
 
 from fully_conv_model_for_lidar_2 import fcn_model
 from util_func import *
+from batch_prefetch import BatchRing, ring_size, input_throughput
 
 
 
@@ -74,14 +75,14 @@ def train_batch_generator(list_of_lidar, list_of_gtbox, batch_size = 1, data_aug
 						car_index = None, undersample = False, percent_noncar = 0.1):
 
 	offset_range = 5*np.pi/180
+	ring = BatchRing([(batch_size, height, width, 2), (batch_size, height, width, 8)], ring_size())
 	ind = 0
 	for lidar_file, box_file in data_generator(list_of_lidar, list_of_gtbox, car_index, undersample , percent_noncar):
 		lidar = np.load(lidar_file)
 		gt_box = np.load(box_file)
 
 		if ind == 0:
-			batch_sample = np.zeros((batch_size, height, width, 2))
-			batch_label = np.zeros((batch_size, height, width, 8))
+			batch_sample, batch_label = ring.take()
 
 		if data_augmentation:
 			# Randomly flip the frame
@@ -186,8 +187,11 @@ if __name__ == '__main__':
 	print('Start training - batch_size : {0} - num_frame : {1} - steps_per_epoch : {2}'.format(batch_size,num_frame,steps_per_epoch))
 	start = time.time()
 
-	model.fit_generator(generator=train_batch_generator(list_of_lidar, list_of_gtbox, batch_size = batch_size, data_augmentation = True, width = 256, height = 64,
-						car_index = car_index, undersample = undersample, percent_noncar = percent_noncar),
+	batches = train_batch_generator(list_of_lidar, list_of_gtbox, batch_size = batch_size, data_augmentation = True, width = 256, height = 64,
+						car_index = car_index, undersample = undersample, percent_noncar = percent_noncar)
+	print('Input pipeline: {0:.1f} samples/s'.format(input_throughput(batches)))
+
+	model.fit_generator(generator=batches,
                        steps_per_epoch=steps_per_epoch,
                        epochs=5,
                        callbacks=[checkpointer, logger])
@@ -12,6 +12,7 @@ from keras.callbacks import ModelCheckpoint, CSVLogger
 
 from fully_conv_model_for_lidar_2 import fcn_model
 from util_func import *
+from batch_prefetch import BatchRing, ring_size, input_throughput
 
 
 
@@ -65,13 +66,13 @@ def train_batch_generator(list_of_view, batch_size = 32, data_augmentation = Tru
 
 	offset_range = input_width - output_width + 1
 	offset = offset_range/2
+	ring = BatchRing([(batch_size, height, output_width, 2), (batch_size, height, output_width, 8)], ring_size())
 	ind = 0
 	for view_file in data_generator(list_of_view):
 		view = np.load(view_file)
 		
 		if ind == 0:
-			batch_sample = np.zeros((batch_size, height, output_width, 2))
-			batch_label = np.zeros((batch_size, height, output_width, 8))
+			batch_sample, batch_label = ring.take()
 
 		if data_augmentation:
 			# Randomly flip the frame
@@ -171,7 +172,10 @@ if __name__ == '__main__':
 	print('Start training - batch_size : {0} - num_frame : {1} - steps_per_epoch : {2}'.format(batch_size,num_frame,steps_per_epoch))
 	start = time.time()
 
-	model.fit_generator(generator=train_batch_generator(list_of_view, batch_size = batch_size, data_augmentation = augmentation, input_width = 286, output_width = 256, height = 64),
+	batches = train_batch_generator(list_of_view, batch_size = batch_size, data_augmentation = augmentation, input_width = 286, output_width = 256, height = 64)
+	print('Input pipeline: {0:.1f} samples/s'.format(input_throughput(batches)))
+
+	model.fit_generator(generator=batches,
                        steps_per_epoch=steps_per_epoch,
                        epochs=epochs,
                        callbacks=[checkpointer, logger])
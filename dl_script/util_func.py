@@ -1,10 +1,14 @@
 import numpy as np
 import math
 import os
+from sklearn.neighbors import KDTree
 from tracklet import Tracklet
 from tracklet import TrackletCollection
 from tracklet import TrackletGT
 from tracklet import parse_xml
+from panorama import panorama_grid
+from panorama import project_segments
+from box_bounds import box_bounds_mask
 #import matplotlib.pyplot as plt
 #import mayavi.mlab
 #from mpl_toolkits.mplot3d import Axes3D
@@ -26,32 +30,11 @@ def cylindrical_projection(lidar,
     return : cylindrical projection (or panorama view) of lidar
     '''
     
-    x = lidar[:,0]
-    y = lidar[:,1]
-    z = lidar[:,2]
-    d = np.sqrt(np.square(x)+np.square(y))
-    
-    
-    theta = np.arctan2(-y, x)
-    phi = -np.arctan2(z, d)
-    
-    x_view = np.int16(np.ceil((theta*180/np.pi - hor_fov[0])/h_res))
-    y_view = np.int16(np.ceil((phi*180/np.pi + ver_fov[1])/v_res))
-    
-    x_max = 255
-    y_max = 63
-    
-    indices = np.logical_and( np.logical_and(x_view >= 0, x_view <= x_max), 
-                           np.logical_and(y_view >= 0, y_view <= y_max)  )
-    
-    x_view = x_view[indices]
-    y_view = y_view[indices]
-    z = z[indices]
-    d = d[indices]
-    d_z = [[d[i],z[i]] for i in range(len(d))]
-    
-    view = np.zeros([y_max+1, x_max+1, 2],dtype=np.float32)
-    view[y_view,x_view] = d_z
+    grid = panorama_grid(ver_fov, hor_fov, v_res, h_res)
+    x_view, y_view, indices, d, _, _ = grid.project(lidar)
+
+    view = grid.empty_view(2)
+    grid.scatter(view, x_view, y_view, indices, np.stack((d, lidar[:,2]), axis=-1))
     return view
 
 
@@ -99,6 +82,47 @@ def in_which_box(point, boxes):
             return i + 1
     return 0
 
+def in_which_box_batch(lidar, boxes):
+    '''
+    vectorized in_which_box, tests all points of lidar (N*D, D>=3) against all boxes (B*8*3) at once
+    return : index (starting from 1) of the first box containing each point, 0 if it isn't in any box
+    '''
+    box_num = np.zeros(len(lidar), dtype=int)
+    if len(boxes) == 0:
+        return box_num
+    
+    # the exact test only runs on the points within the bounds of some box
+    candidates = np.any(box_bounds_mask(lidar, boxes), axis=1)
+    if not np.any(candidates):
+        return box_num
+    
+    point = lidar[candidates, np.newaxis, :3]
+    low = np.min(boxes[:, :, 2], axis=1)
+    high = np.max(boxes[:, :, 2], axis=1)
+    
+    v = point[:, :, :2] - boxes[:, 0, :2]
+    v1 = boxes[:, 1, :2] - boxes[:, 0, :2]
+    v2 = boxes[:, 3, :2] - boxes[:, 0, :2]
+    
+    det1 = v[:, :, 0] * v2[:, 1] - v[:, :, 1] * v2[:, 0]
+    det2 = v[:, :, 0] * v1[:, 1] - v[:, :, 1] * v1[:, 0]
+    
+    with np.errstate(divide='ignore', invalid='ignore'):
+        t1 = (v1[:, 0] * v2[:, 1] - v1[:, 1] * v2[:, 0]) / det1
+        s1 = (v1[:, 0] * v[:, :, 1] - v1[:, 1] * v[:, :, 0]) / det1
+        t2 = (v2[:, 0] * v1[:, 1] - v2[:, 1] * v1[:, 0]) / det2
+        s2 = (v2[:, 0] * v[:, :, 1] - v2[:, 1] * v[:, :, 0]) / det2
+    
+    # same tests as is_in_box, kept as negations so that they agree on nan
+    inside = np.logical_not((point[:, :, 2] >= high) | (point[:, :, 2] <= low))
+    inside &= (det1 != 0) & (det2 != 0)
+    inside &= np.logical_not((t1 <= 1) | (s1 <= 0))
+    inside &= np.logical_not((t2 <= 1) | (s2 <= 0))
+    
+    box_num[candidates] = np.where(np.any(inside, axis=1), np.argmax(inside, axis=1) + 1, 0)
+    return box_num
+
+
 
 
 def cylindrical_projection_for_training(lidar,
@@ -118,38 +142,16 @@ def cylindrical_projection_for_training(lidar,
     return : cylindrical projection (or panorama view) of lidar
     '''
     
-    x = lidar[:,0]
-    y = lidar[:,1]
-    z = lidar[:,2]
-    d = np.sqrt(np.square(x)+np.square(y))
-    
-    
-    theta = np.arctan2(-y, x)
-    phi = -np.arctan2(z, d)
-    
-    x_view = np.int16(np.ceil((theta*180/np.pi - hor_fov[0])/h_res))
-    y_view = np.int16(np.ceil((phi*180/np.pi + ver_fov[1])/v_res))
-    
-    x_max = 255
-    y_max = 63
-    
-    indices = np.logical_and( np.logical_and(x_view >= 0, x_view <= x_max), 
-                           np.logical_and(y_view >= 0, y_view <= y_max)  )
-    
-    x_view = x_view[indices]
-    y_view = y_view[indices]
-    z = z[indices]
-    d = d[indices]
-    d_z = [[d[i],z[i]] for i in range(len(d))]
-    
-    view = np.zeros([y_max+1, x_max+1, 2],dtype=np.float32)
-    view[y_view,x_view] = d_z
-    
-    encode_boxes = np.array([box_encoder(lidar[i], gt_box3d) for i in range(len(lidar))])
-    encode_boxes = encode_boxes[indices]
-    
-    box = np.zeros([y_max+1, x_max+1, 8],dtype=np.float32)
-    box[y_view,x_view] = encode_boxes
+    grid = panorama_grid(ver_fov, hor_fov, v_res, h_res)
+    x_view, y_view, indices, d, _, _ = grid.project(lidar)
+
+    view = grid.empty_view(2)
+    grid.scatter(view, x_view, y_view, indices, np.stack((d, lidar[:,2]), axis=-1))
+
+    encode_boxes = box_encoder_batch(lidar, gt_box3d)
+
+    box = grid.empty_view(8)
+    grid.scatter(box, x_view, y_view, indices, encode_boxes)
     
     return view, box
 
@@ -181,67 +183,28 @@ def cylindrical_projection_for_training(lidar,
 #     return view, box
 
 def cylindrical_projection_for_test(lidar,
-                                       #gt_box3d,
-<<<<<<< HEAD
+                                    #gt_box3d,
                                     ver_fov = (-24.4, 2.),#(-24.9, 2.), 
                                     hor_fov = (-42.,42.), 
                                     v_res = 0.42,
-                                    h_res = 0.33):
-||||||| merged common ancestors
-                                       ver_fov = (-24.4, 15.),#(-24.9, 2.), 
-                                       hor_fov = (-130.,42.), 
-                                       v_res = 1,
-                                       h_res = 1,
-                                       d_max = None):
-=======
-                                       ver_fov = (-24.4, 15.),#(-24.9, 2.), 
-                                       hor_fov = (-130.,42.), 
-                                       v_res = 0.42,
-                                       h_res = 0.33,
-                                       d_max = None):
->>>>>>> e8d53df5d4bd876618ecf8b0bd7c7e833035214b
+                                    h_res = 0.33,
+                                    shape = None):
     '''
     lidar: a numpy array of shape N*D, D>=3
     ver_fov : angle range of vertical projection in degree
     hor_fov: angle range of horizantal projection in degree
     v_res : vertical resolusion
     h_res : horizontal resolution
-    d_max : maximun range distance
+    shape : (height, width) of the view, derived from fov and resolution if None
     
     return : cylindrical projection (or panorama view) of lidar
     '''
     
-    x = lidar[:,0]
-    y = lidar[:,1]
-    z = lidar[:,2]
-    d = np.sqrt(np.square(x)+np.square(y))
-        
-    
-    theta = np.arctan2(-y, x)
-    phi = -np.arctan2(z, d)
-    
-    x_view = np.int16(np.ceil((theta*180/np.pi - hor_fov[0])/h_res))
-    y_view = np.int16(np.ceil((phi*180/np.pi + ver_fov[1])/v_res))
-    
-    x_max = 255
-    y_max = 63
-    
-    indices = np.logical_and( np.logical_and(x_view >= 0, x_view <= x_max), 
-                           np.logical_and(y_view >= 0, y_view <= y_max)  )
-    
-    x_view = x_view[indices]
-    y_view = y_view[indices]
-    x = x[indices]
-    y = y[indices]
-    z = z[indices]
-    d = d[indices]
-    
-    theta = theta[indices]
-    phi = phi[indices]
-    coord = [[x[i],y[i],z[i],theta[i],phi[i],d[i]] for i in range(len(x))]
-    
-    view = np.zeros([y_max+1, x_max+1, 6],dtype=np.float32)
-    view[y_view,x_view] = coord
+    grid = panorama_grid(ver_fov, hor_fov, v_res, h_res, shape)
+    x_view, y_view, indices, d, theta, phi = grid.project(lidar)
+
+    view = grid.empty_view(6)
+    grid.scatter(view, x_view, y_view, indices, np.stack((lidar[:,0], lidar[:,1], lidar[:,2], theta, phi, d), axis=-1))
     
     return view
 
@@ -261,6 +224,17 @@ def rotation_y(phi, point):
     out[2] = -v*point[0] + u*point[2]
     return out
 
+def rotation_v(theta, points):
+    '''
+    vectorized rotation: rotates each point of points (N*3) by its own angle in theta (N)
+    '''
+    v = np.sin(theta)
+    u = np.cos(theta)
+    out = np.copy(points)
+    out[:,0] = u*points[:,0] + v*points[:,1]
+    out[:,1] = -v*points[:,0] + u*points[:,1]
+    return out
+
 
 def flip_rotation(theta, point):
     v = np.sin(theta)
@@ -301,6 +275,46 @@ def box_encoder(point, boxes):
     return np.array([1, ru0[0], ru0[1], ru0[2], ru6[0], ru6[1], ru6[2], phi])
 
 
+def box_encoder_batch(lidar, boxes):
+    '''
+    vectorized box_encoder, encodes all points of lidar (N*D, D>=3) at once
+    return : numpy array of shape N*8, zeros for the points outside of every box
+    '''
+    encode_boxes = np.zeros((len(lidar), 8))
+    
+    box_num = in_which_box_batch(lidar, boxes)
+    inside = box_num > 0
+    if not np.any(inside):
+        return encode_boxes
+    
+    point = lidar[inside, :3]
+    box = boxes[box_num[inside] - 1]
+    
+    theta = np.arctan2(-point[:, 1], point[:, 0])
+    v = np.sin(-theta)
+    u = np.cos(-theta)
+    
+    u0 = point - box[:, 0]
+    u6 = point - box[:, 6]
+    
+    x = np.sqrt(np.sum(np.square(box[:, 1, :2] - box[:, 2, :2]), axis=1))
+    z = np.sqrt(np.sum(np.square(box[:, 0, :2] - box[:, 2, :2]), axis=1))
+    
+    encode = np.empty((len(point), 8))
+    encode[:, 0] = 1
+    encode[:, 1] = u * u0[:, 0] + v * u0[:, 1]
+    encode[:, 2] = -v * u0[:, 0] + u * u0[:, 1]
+    encode[:, 3] = u0[:, 2]
+    encode[:, 4] = u * u6[:, 0] + v * u6[:, 1]
+    encode[:, 5] = -v * u6[:, 0] + u * u6[:, 1]
+    encode[:, 6] = u6[:, 2]
+    encode[:, 7] = np.arcsin(x / z)
+    encode_boxes[inside] = encode
+    
+    return encode_boxes
+
+
+
 
 
 def augmentation(offset, flip, lidar, gtboxes):
@@ -333,6 +347,97 @@ def augmentation(offset, flip, lidar, gtboxes):
 	return out_lidar, out_gtboxes
 
 
+def decode_corner_boxes(view, pred, thres):
+    '''
+    view : cylindrical view (x, y, z, theta, phi, d) of shape (..., 6), see cylindrical_projection_for_test
+    pred : network output of shape (..., 8) for the same pixels
+    thres : threshold on the objectness pred[...,0]
+    
+    return : corners of the boxes predicted by every pixel above thres, shape N*8*3
+    '''
+    view = view.reshape(-1,6)
+    pred = pred.reshape(-1,8)
+    indices = pred[:,0] > thres
+    thres_view = view[indices]
+    thres_pred = pred[indices]
+    
+    boxes = np.zeros((len(thres_pred),8,3))
+    
+    boxes[:,0] = thres_view[:,:3] - rotation_v(thres_view[:,3], thres_pred[:,1:4])
+    boxes[:,6] = thres_view[:,:3] - rotation_v(thres_view[:,3], thres_pred[:,4:7])
+    
+    boxes[:,2,:2] = boxes[:,6,:2]
+    boxes[:,2,2] = boxes[:,0,2]
+    
+    cos_phi = np.cos(thres_pred[:,-1])
+    sin_phi = np.sin(thres_pred[:,-1])
+    
+    z = boxes[:,2] - boxes[:,0]
+    boxes[:,1,0] = (cos_phi*z[:,0] + sin_phi*z[:,1])*cos_phi + boxes[:,0,0]
+    boxes[:,1,1] = (-sin_phi*z[:,0] + cos_phi*z[:,1])*cos_phi + boxes[:,0,1]
+    boxes[:,1,2] = boxes[:,0,2]
+    
+    boxes[:,3] = boxes[:,0] + boxes[:,2] - boxes[:,1]
+    boxes[:,4] = boxes[:,0] + boxes[:,6] - boxes[:,2]
+    boxes[:,5] = boxes[:,1] + boxes[:,4] - boxes[:,0]
+    boxes[:,7] = boxes[:,4] + boxes[:,6] - boxes[:,5]
+    
+    return boxes
+
+
+def greedy_box_clustering(boxes, cluster_dist=0.1, min_dist=1.5, neigbor_thres=3):
+    '''
+    boxes : numpy array of shape N*8*3
+    cluster_dist : boxes closer than cluster_dist are neighbors
+    min_dist : boxes within min_dist of a kept box are dropped
+    neigbor_thres : minimum number of neighbors (itself included) of a kept box
+    
+    return : list of the kept boxes, picked greedily by their number of remaining neighbors.
+             distances are taken between the flattened corners of two boxes, a KD-tree
+             gathers the candidate pairs so no dense N*N distance matrix is built
+    '''
+    cluster_boxes = []
+    num_boxes = len(boxes)
+    if num_boxes == 0:
+        return cluster_boxes
+    
+    flatten_boxes = boxes.reshape(-1,24)
+    tree = KDTree(flatten_boxes)
+    
+    def box_dist(rows, cols):
+        return np.sqrt(np.sum(np.square(flatten_boxes[rows] - flatten_boxes[cols]), axis = 1))
+    
+    # the tree radius is slightly loosened, the thresholds are applied on box_dist
+    neighbors = tree.query_radius(flatten_boxes, r=cluster_dist*(1+1e-6)+1e-9)
+    rows = np.repeat(np.arange(num_boxes), [len(n) for n in neighbors])
+    cols = np.concatenate(neighbors)
+    is_neighbor = box_dist(rows, cols) < cluster_dist
+    rows = rows[is_neighbor]
+    cols = cols[is_neighbor]
+    
+    neighbor = np.bincount(rows, minlength=num_boxes)
+    remaining = np.ones(num_boxes, dtype=bool)
+    
+    while True:
+        ind = np.argmax(np.where(remaining, neighbor, -1))
+        
+        if not remaining[ind] or neighbor[ind] < neigbor_thres:
+            break
+        
+        cluster_boxes.append(boxes[ind])
+        
+        near = tree.query_radius(flatten_boxes[[ind]], r=min_dist*(1+1e-6)+1e-9)[0]
+        near = near[remaining[near]]
+        removed = near[np.logical_not(box_dist(np.full(len(near), ind), near) > min_dist)]
+        
+        remaining[removed] = False
+        is_removed = np.zeros(num_boxes, dtype=bool)
+        is_removed[removed] = True
+        np.subtract.at(neighbor, cols[is_removed[rows]], 1)
+    
+    return cluster_boxes
+
+
 def predict_boxes(model, lidar, 
                    cluster=True, seg_thres=0.5, cluster_dist=0.1, min_dist=1.5, neigbor_thres=3,
                    ver_fov=(-24.4, 15.), v_res=0.42,
@@ -353,77 +458,18 @@ def predict_boxes(model, lidar,
         
     all_boxes = np.empty((0,8,3))
     
+    # project every segment in one pass and predict them as a single batch
+    views = project_segments(lidar, hor_fov_arr, ver_fov, v_res, h_res, shape=(64,256))
+    preds = model.predict(views[:,:,:,[5,2]], batch_size=num_hor_seg)
+    
     for ns in range(num_hor_seg):
-        view =  cylindrical_projection_for_test(lidar, hor_fov=hor_fov_arr[ns], h_res=h_res,
-                                               ver_fov=ver_fov, v_res=v_res)
-        cylindrical_view = view[:,:,[5,2]].reshape(1,64,256,2)
-        pred = model.predict(cylindrical_view)
-        pred = pred[0]
-        pred = pred.reshape(-1,8)
-        view = view.reshape(-1,6)
-        thres_pred = pred[pred[:,0] > seg_thres]
-        thres_view = view[pred[:,0] > seg_thres]
-        
-        num_boxes = len(thres_pred)
-        boxes = np.zeros((num_boxes,8,3))
-        
-        for i in range(num_boxes):
-            boxes[i,0] = thres_view[i,:3] - rotation(thres_view[i,3],thres_pred[i,1:4])
-            boxes[i,6] = thres_view[i,:3] - rotation(thres_view[i,3],thres_pred[i,4:7])
-
-            boxes[i,2,:2] = boxes[i,6,:2]
-            boxes[i,2,2] = boxes[i,0,2]
-
-            phi = thres_pred[i,-1]
-
-            z = boxes[i,2] - boxes[i,0]
-            boxes[i,1,0] = (np.cos(phi)*z[0] + np.sin(phi)*z[1])*np.cos(phi) + boxes[i,0,0]
-            boxes[i,1,1] = (-np.sin(phi)*z[0] + np.cos(phi)*z[1])*np.cos(phi) + boxes[i,0,1]
-            boxes[i,1,2] = boxes[i,0,2]
-
-            boxes[i,3] = boxes[i,0] + boxes[i,2] - boxes[i,1]
-            boxes[i,4] = boxes[i,0] + boxes[i,6] - boxes[i,2]
-            boxes[i,5] = boxes[i,1] + boxes[i,4] - boxes[i,0]
-            boxes[i,7] = boxes[i,4] + boxes[i,6] - boxes[i,5]
-        
+        boxes = decode_corner_boxes(views[ns], preds[ns], seg_thres)
         all_boxes = np.vstack((all_boxes, boxes))
 
     if not cluster:
         return all_boxes
     
-    boxes_tmp = np.copy(all_boxes)
-
-    flatteb_boxes = all_boxes.reshape(-1,24)
-    num_box_total = len(all_boxes)
-    box_dist = np.zeros((num_box_total, num_box_total))
-    for i in range(num_box_total):
-        box_dist[i] = np.sqrt(np.sum(np.square(flatteb_boxes[[i]] - flatteb_boxes), axis = 1))
-
-    thres_box_dist = box_dist < cluster_dist
-    neighbor = np.sum(thres_box_dist, axis = 1)
-    
-    cluster_boxes = []
-
-    while len(neighbor)>0:
-
-        ind = np.argmax(neighbor)
-
-        if neighbor[ind] < neigbor_thres:
-            break
-
-        cluster_boxes.append(boxes_tmp[ind])
-
-        remain_indx = box_dist[ind] > min_dist
-
-        box_dist = box_dist[remain_indx]
-        box_dist = box_dist[:,remain_indx]
-
-        thres_box_dist = thres_box_dist[remain_indx]
-        thres_box_dist = thres_box_dist[:,remain_indx]
-
-        boxes_tmp = boxes_tmp[remain_indx]
-
-        neighbor = np.sum(thres_box_dist, axis = 1)
+    cluster_boxes = greedy_box_clustering(all_boxes, cluster_dist, min_dist, neigbor_thres)
     
     return all_boxes, np.array(cluster_boxes) 
 
@@ -0,0 +1,104 @@
+#!/usr/bin/env python
+import argparse
+import glob
+import json
+import os
+
+import numpy as np
+
+from sparse_view import load_view, unique_views
+
+INDEX_FILE = 'index.json'
+SHARD_SIZE = 4096 # views per shard
+
+
+def pack_views(list_of_view, shard_dir, shard_size=SHARD_SIZE):
+    '''
+    pack views of one shape (dense .npy or sparse .npz files) into memory mapped .npy shards of
+    shard_size views each, with an index file listing the shards and the source file of every view
+    '''
+    if not os.path.exists(shard_dir):
+        os.makedirs(shard_dir)
+
+    first = load_view(list_of_view[0])
+    shards = []
+    for start in range(0, len(list_of_view), shard_size):
+        files = list_of_view[start:start + shard_size]
+        name = 'shard_{0:04d}.npy'.format(len(shards))
+        shard = np.lib.format.open_memmap(os.path.join(shard_dir, name), mode='w+',
+                                          dtype=first.dtype, shape=(len(files),) + first.shape)
+        for i, f in enumerate(files):
+            view = load_view(f)
+            assert view.shape == first.shape, "{0} has shape {1}, expected {2}".format(f, view.shape, first.shape)
+            shard[i] = view
+        shard.flush()
+        del shard
+        shards.append({'file': name, 'count': len(files)})
+
+    # time every view file (or its link to the view cache) was written, to detect views converted again
+    mtimes = [os.lstat(f).st_mtime for f in list_of_view]
+    index = {'shape': list(first.shape), 'dtype': str(first.dtype), 'shards': shards, 'views': list(list_of_view),
+             'mtimes': mtimes}
+    with open(os.path.join(shard_dir, INDEX_FILE), 'w') as f:
+        json.dump(index, f)
+
+
+def stale_views(shard_dir, list_of_view):
+    '''
+    views of list_of_view that are not in the shards of shard_dir or were written again since they were
+    packed, and packed views missing from list_of_view. Empty when the shards are up to date.
+    '''
+    with open(os.path.join(shard_dir, INDEX_FILE)) as f:
+        index = json.load(f)
+    # shards packed before the index recorded the mtimes are out of date
+    packed = dict(zip([os.path.abspath(v) for v in index['views']], index.get('mtimes', [])))
+    current = set(os.path.abspath(v) for v in list_of_view)
+    stale = [v for v in list_of_view
+             if os.path.abspath(v) not in packed or os.lstat(v).st_mtime > packed[os.path.abspath(v)]]
+    return stale + [v for v in index['views'] if os.path.abspath(v) not in current]
+
+
+class ViewShards(object):
+    '''
+    Views packed by pack_views, read through memory maps: view i is a slice of its shard,
+    only the bytes actually used are read from disk.
+    Behaves as a list of views (len and indexing), so it can replace a list of view files.
+    '''
+
+    def __init__(self, shard_dir):
+        with open(os.path.join(shard_dir, INDEX_FILE)) as f:
+            self.index = json.load(f)
+        self.shards = [np.load(os.path.join(shard_dir, s['file']), mmap_mode='r') for s in self.index['shards']]
+        counts = [s['count'] for s in self.index['shards']]
+        # first view of every shard
+        self.starts = np.cumsum([0] + counts[:-1])
+        self.count = sum(counts)
+
+    def __len__(self):
+        return self.count
+
+    def __getitem__(self, i):
+        if i < 0:
+            i += self.count
+        if i < 0 or i >= self.count:
+            raise IndexError("view index out of range")
+        shard = np.searchsorted(self.starts, i, side='right') - 1
+        return self.shards[shard][i - self.starts[shard]]
+
+    def source(self, i):
+        '''
+        file the view i was packed from
+        '''
+        return self.index['views'][i]
+
+
+if __name__ == '__main__':
+    parser = argparse.ArgumentParser(description='pack the training views into memory mapped shards')
+    parser.add_argument('data_dir', help='directory of the bags, holding the views in <bag>/view')
+    parser.add_argument('shard_dir', help='directory of the shards to write')
+    parser.add_argument('--shard-size', type=int, default=SHARD_SIZE, help='views per shard')
+    args = parser.parse_args()
+
+    list_of_view = unique_views(sorted(glob.glob(os.path.join(args.data_dir, '*', 'view', '*.np[yz]'))))
+    pack_views(list_of_view, args.shard_dir, args.shard_size)
+    print('packed {0} views into {1}'.format(len(list_of_view), args.shard_dir))
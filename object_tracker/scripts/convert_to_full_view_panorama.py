@@ -1,14 +1,39 @@
 import numpy as np
 import os
+import json
 import time
-from multiprocessing import Pool
+import traceback
+from multiprocessing import Pool, cpu_count
 from multiprocessing import Process
 
 from sklearn.cluster import DBSCAN
+from scipy import ndimage
+
+from panorama import panorama_grid
+from box_bounds import box_bounds_mask
+from sparse_view import save_sparse_view, SPARSE_EXT
+from view_cache import ViewCache
 
 lidar_dir = './data/training_didi_data/car_train_edited/'
 gt_box_dir = './data/training_didi_data/car_train_gt_box_edited/'
 list_bad_frames = './logs/list_bad_label_frames.txt'
+failure_log = './logs/convert_failures.txt'
+# converted views of every projection configuration, the view directories of the bags link to them
+# (see convert_frame). None writes the views in the view directories
+view_cache_dir = './data/training_didi_data/view_cache/'
+
+# grid clustering parameters of the c++ point filter (object_tracker/include/object_tracker/define.h)
+GROUND_Z = -1.3
+GROUND_EPS = 0.1
+CAR_ROI_RADIUS = 35.
+CAR_RESOLUTION = 0.8
+
+SPARSE_VIEWS = True # save the training views with only their occupied pixels (see sparse_view.py)
+
+# parameters of fv_cylindrical_projection_for_train used for the training views, the views of a bag
+# are converted again when they change (see outdated_tasks)
+PROJECTION_PARAMS = {'ver_fov': (-22, 4.), 'v_res': 1.8, 'h_res': 1.13, 'angle_offset': 5, 'clustering': True}
+PARAMS_FILE = 'view_params.json' # next to the view directory of every bag
 
 def box_encoder(point, boxes):
     '''
@@ -39,6 +64,46 @@ def box_encoder(point, boxes):
     return np.array([1, ru0[0], ru0[1], ru0[2], ru6[0], ru6[1], ru6[2], phi])
 
 
+def box_encoder_batch(lidar, boxes):
+    '''
+    vectorized box_encoder, encodes all points of lidar (N*D, D>=3) at once
+    return : numpy array of shape N*8, zeros for the points outside of every box
+    '''
+    encode_boxes = np.zeros((len(lidar), 8))
+    
+    box_num = in_which_box_batch(lidar, boxes)
+    inside = box_num > 0
+    if not np.any(inside):
+        return encode_boxes
+    
+    point = lidar[inside, :3]
+    box = boxes[box_num[inside] - 1]
+    
+    theta = np.arctan2(-point[:, 1], point[:, 0])
+    v = np.sin(-theta)
+    u = np.cos(-theta)
+    
+    u0 = point - box[:, 0]
+    u6 = point - box[:, 6]
+    
+    x = np.sqrt(np.sum(np.square(box[:, 1, :2] - box[:, 2, :2]), axis=1))
+    z = np.sqrt(np.sum(np.square(box[:, 0, :2] - box[:, 2, :2]), axis=1))
+    
+    encode = np.empty((len(point), 8))
+    encode[:, 0] = 1
+    encode[:, 1] = u * u0[:, 0] + v * u0[:, 1]
+    encode[:, 2] = -v * u0[:, 0] + u * u0[:, 1]
+    encode[:, 3] = u0[:, 2]
+    encode[:, 4] = u * u6[:, 0] + v * u6[:, 1]
+    encode[:, 5] = -v * u6[:, 0] + u * u6[:, 1]
+    encode[:, 6] = u6[:, 2]
+    encode[:, 7] = np.arcsin(x / z)
+    encode_boxes[inside] = encode
+    
+    return encode_boxes
+
+
+
 def rotation(theta, point):
     v = np.sin(theta)
     u = np.cos(theta)
@@ -113,6 +178,47 @@ def in_which_box(point, boxes):
             return i + 1
     return 0
 
+def in_which_box_batch(lidar, boxes):
+    '''
+    vectorized in_which_box, tests all points of lidar (N*D, D>=3) against all boxes (B*8*3) at once
+    return : index (starting from 1) of the first box containing each point, 0 if it isn't in any box
+    '''
+    box_num = np.zeros(len(lidar), dtype=int)
+    if len(boxes) == 0:
+        return box_num
+    
+    # the exact test only runs on the points within the bounds of some box
+    candidates = np.any(box_bounds_mask(lidar, boxes), axis=1)
+    if not np.any(candidates):
+        return box_num
+    
+    point = lidar[candidates, np.newaxis, :3]
+    low = np.min(boxes[:, :, 2], axis=1)
+    high = np.max(boxes[:, :, 2], axis=1)
+    
+    v = point[:, :, :2] - boxes[:, 0, :2]
+    v1 = boxes[:, 1, :2] - boxes[:, 0, :2]
+    v2 = boxes[:, 3, :2] - boxes[:, 0, :2]
+    
+    det1 = v[:, :, 0] * v2[:, 1] - v[:, :, 1] * v2[:, 0]
+    det2 = v[:, :, 0] * v1[:, 1] - v[:, :, 1] * v1[:, 0]
+    
+    with np.errstate(divide='ignore', invalid='ignore'):
+        t1 = (v1[:, 0] * v2[:, 1] - v1[:, 1] * v2[:, 0]) / det1
+        s1 = (v1[:, 0] * v[:, :, 1] - v1[:, 1] * v[:, :, 0]) / det1
+        t2 = (v2[:, 0] * v1[:, 1] - v2[:, 1] * v1[:, 0]) / det2
+        s2 = (v2[:, 0] * v[:, :, 1] - v2[:, 1] * v[:, :, 0]) / det2
+    
+    # same tests as is_in_box, kept as negations so that they agree on nan
+    inside = np.logical_not((point[:, :, 2] >= high) | (point[:, :, 2] <= low))
+    inside &= (det1 != 0) & (det2 != 0)
+    inside &= np.logical_not((t1 <= 1) | (s1 <= 0))
+    inside &= np.logical_not((t2 <= 1) | (s2 <= 0))
+    
+    box_num[candidates] = np.where(np.any(inside, axis=1), np.argmax(inside, axis=1) + 1, 0)
+    return box_num
+
+
 ###############################################################
 #### This function is used to replace function in_which_boxes() 
 ###############################################################
@@ -142,61 +248,66 @@ def cylindrical_projection_for_training(lidar, gt_box3d, ver_fov=(-24.4, 2.), ho
     return : cylindrical projection (or panorama view) of lidar
     '''
 
-    x = lidar[:, 0]
-    y = lidar[:, 1]
-    z = lidar[:, 2]
-    
-    ind = np.where(z>-1.27)
-    x=x[ind]
-    y=y[ind]
-    z=z[ind]
-    
-    d = np.sqrt(np.square(x) + np.square(y))
+    lidar = lidar[lidar[:, 2] > -1.27]
 
-    theta = np.arctan2(-y, x)
-    phi = -np.arctan2(z, d)
+    grid = panorama_grid(ver_fov, hor_fov, v_res, h_res)
+    x_view, y_view, indices, d, _, _ = grid.project(lidar)
 
-    x_view = np.int16(np.ceil((theta * 180 / np.pi - hor_fov[0]) / h_res))
-    y_view = np.int16(np.ceil((phi * 180 / np.pi + ver_fov[1]) / v_res))
+    view = grid.empty_view(10)
+    grid.scatter(view[:, :, :2], x_view, y_view, indices, np.stack((d, lidar[:, 2]), axis=-1))
 
-    x_max = np.int16(np.ceil((hor_fov[1] - hor_fov[0]) / h_res))
-    y_max = 63
+    encode_boxes = box_encoder_batch(lidar, gt_box3d)
 
-    indices = np.logical_and(np.logical_and(x_view >= 0, x_view <= x_max),
-                             np.logical_and(y_view >= 0, y_view <= y_max))
+    grid.scatter(view[:, :, 2:], x_view, y_view, indices, encode_boxes)
 
-    x_view = x_view[indices]
-    y_view = y_view[indices]
-    z = z[indices]
-    d = d[indices]
-    d_z = [[d[i], z[i]] for i in range(len(d))]
+    return view
 
-    view = np.zeros([y_max + 1, x_max + 1, 10], dtype=np.float32)
-    view[y_view, x_view, :2] = d_z
+##########################################################################################
+######     Clustering 
+##########################################################################################
+def grid_cluster(lidar, resolution = CAR_RESOLUTION, roi_radius = CAR_ROI_RADIUS, min_top = GROUND_Z + 2*GROUND_EPS):
+    '''
+    numpy version of the ClusterBuilder of the c++ point filter: points are binned into an xy grid
+    of the given resolution around the origin, and the cells whose highest point is above min_top
+    are grouped into clusters by 8-connectivity
     
+    return : cluster label of every point, -1 for points out of the roi or in a cell that is too low
+    '''
+    iradius = int(roi_radius / resolution + 0.5)
+    iwidth = int(2 * roi_radius / resolution + 0.5)
+    labels = -np.ones(len(lidar), dtype=int)
     
+    # cell indices are truncated like the c++ int casts
+    rx = np.trunc(lidar[:,0] / resolution + 0.5).astype(int)
+    ry = np.trunc(lidar[:,1] / resolution + 0.5).astype(int)
+    ix = np.trunc((lidar[:,0] + roi_radius) / resolution + 0.5).astype(int)
+    iy = np.trunc((lidar[:,1] + roi_radius) / resolution + 0.5).astype(int)
+    in_roi = (rx*rx + ry*ry <= iradius*iradius) * (ix >= 0) * (ix < iwidth) * (iy >= 0) * (iy < iwidth)
+    cell = ix[in_roi] * iwidth + iy[in_roi]
     
-    encode_boxes = np.array([box_encoder(lidar[i], gt_box3d) for i in range(len(lidar))])
-    encode_boxes = encode_boxes[indices]
-
-    # box = np.zeros([y_max+1, x_max+1, 8],dtype=np.float32)
-    view[y_view, x_view, 2:] = encode_boxes
+    top = -np.inf * np.ones(iwidth * iwidth)
+    np.maximum.at(top, cell, lidar[in_roi,2])
+    occupied = (top >= min_top).reshape(iwidth, iwidth)
+    
+    # clusters are numbered in the scan order of the c++ region growing
+    cell_labels, _ = ndimage.label(occupied, structure = np.ones((3,3)))
+    labels[in_roi] = cell_labels.reshape(-1)[cell] - 1
+    return labels
 
-    return view
 
-##########################################################################################
-######     Clustering 
-##########################################################################################
 def cluster(lidar, min_d = 2, min_z = -1.35, max_z = 0.5, max_xrange = 6,
             max_yrange = 6, min_xrange = 0.5, min_yrange = 0.5,  
-            min_zrange = 0.2, min_points = 15, z_scale = 1.,eps = 0.8, min_samples = 1):
+            min_zrange = 0.2, min_points = 15, z_scale = 1.,eps = 0.8, min_samples = 1,
+            method = 'dbscan'):
     '''
     min_z : remove points whose z <= min_z (ground removing)
     min_d : remove points within distance of min_d
     z_scale: scale z coordinate before clustering
     eps, min_smaples: parameters of DBSCAN 
     max_xrange, min_xrange, max_yrange, min_yrange, min_zrange : filter out x,y,z range of clusters 
+    method : 'dbscan' or 'grid' (grid_cluster, as the c++ point filter; z_scale, eps and min_samples are ignored)
     '''
+    assert method in ('dbscan', 'grid'), "unknown clustering method"
 
 
     # remove ground points
@@ -204,40 +315,40 @@ def cluster(lidar, min_d = 2, min_z = -1.35, max_z = 0.5, max_xrange = 6,
     # remove near points (can improve)
     d = np.sqrt(np.square(lidar[:,0]) + np.square(lidar[:,1]))
     lidar = lidar[d>=min_d]
-    # scale z
-    lidar1 = np.copy(lidar)
-    lidar1[:,2] = (lidar1[:,2]+min_z)/z_scale
-    # Clustering
-    db = DBSCAN(eps=eps, min_samples=min_samples).fit(lidar1)
-    labels = db.labels_
+    if method == 'grid':
+        # Clustering, dropping the points left out of any cluster
+        labels = grid_cluster(lidar)
+        lidar = lidar[labels >= 0]
+        labels = labels[labels >= 0]
+    else:
+        # scale z
+        lidar1 = np.copy(lidar)
+        lidar1[:,2] = (lidar1[:,2]+min_z)/z_scale
+        # Clustering
+        db = DBSCAN(eps=eps, min_samples=min_samples).fit(lidar1)
+        labels = db.labels_
+    if len(labels) == 0:
+        # nothing left to cluster (e.g. a frame of ground points only)
+        return lidar, labels
     # filter max_z, max_xrange = 3, max_yrange, min_zrange 
-    label_set = list(set(labels))
-    cluster_height = np.zeros(len(label_set))
-    cluster_zrange = np.zeros(len(label_set))
-    cluster_xrange = np.zeros(len(label_set))
-    cluster_yrange = np.zeros(len(label_set))
-    n_points = np.zeros(len(label_set))
-    for i in range(len(label_set)):
-        z_cluster = lidar[:,2][labels == label_set[i]]
-        cluster_height[i] = np.max(z_cluster)
-        cluster_zrange[i] = cluster_height[i] - np.min(z_cluster)
-        
-        x_cluster = lidar[:,0][labels == label_set[i]]
-        cluster_xrange[i] = np.max(x_cluster) - np.min(x_cluster)
-        
-        y_cluster = lidar[:,1][labels == label_set[i]]
-        cluster_yrange[i] = np.max(y_cluster) - np.min(y_cluster)
-        
-        n_points[i] = np.sum(labels == label_set[i])
-        
-    features = np.array([[cluster_height[labels[i]], cluster_xrange[labels[i]], cluster_yrange[labels[i]], 
-                          cluster_zrange[labels[i]], n_points[labels[i]] ]  for i in range(len(labels))])
+    # per cluster statistics in one pass: points are sorted by label and reduced per label
+    label_set, inverse, n_points = np.unique(labels, return_inverse=True, return_counts=True)
+    order = np.argsort(inverse, kind='mergesort')
+    starts = np.concatenate(([0], np.cumsum(n_points)[:-1]))
+    cluster_min = np.minimum.reduceat(lidar[order,:3], starts)
+    cluster_max = np.maximum.reduceat(lidar[order,:3], starts)
+    
+    cluster_height = cluster_max[:,2].astype(np.float64)
+    cluster_zrange = cluster_height - cluster_min[:,2]
+    cluster_xrange = (cluster_max[:,0] - cluster_min[:,0]).astype(np.float64)
+    cluster_yrange = (cluster_max[:,1] - cluster_min[:,1]).astype(np.float64)
     
-    index = (features[:,0]<=max_z)*(features[:,1]<=max_xrange)*(features[:,2]<=max_yrange)*(features[:,3]>=min_zrange)*(features[:,4]>=min_points)
+    keep = (cluster_height<=max_z)*(cluster_xrange<=max_xrange)*(cluster_yrange<=max_yrange)*(cluster_zrange>=min_zrange)*(n_points>=min_points)
     if min_xrange != None:
-        index = index*(features[:,1]>= min_xrange)
+        keep = keep*(cluster_xrange>= min_xrange)
     if min_yrange != None:
-        index = index*(features[:,2]>= min_yrange)
+        keep = keep*(cluster_yrange>= min_yrange)
+    index = keep[inverse]
     return lidar[index], labels[index]
 
 
@@ -270,56 +381,32 @@ def fv_cylindrical_projection_for_train(lidar,
          # remove ground points
         lidar = lidar[lidar[:,2]>= -1.4]
 
-    x = lidar[:,0]
-    y = lidar[:,1]
+    grid = panorama_grid(ver_fov, (-180., 180.), v_res, h_res)
+    x_view, y_view, indices, d, _, _ = grid.project(lidar)
     z = lidar[:,2]
-    
-    d = np.sqrt(np.square(x)+np.square(y))
     if not clustering:
         # remove near points
         lidar = lidar[d>=2]
 
-    theta = np.arctan2(-y, x)
-    phi = -np.arctan2(z, d)
-       
-    
-    x_view = np.int16(np.ceil((theta*180/np.pi + 180)/h_res))
-    y_view = np.int16(np.ceil((phi*180/np.pi + ver_fov[1])/v_res))
-    
-    x_max = np.int16(np.ceil(360/h_res))
-    y_max = np.int16(np.ceil((ver_fov[1] - ver_fov[0])/v_res))
-    
-    view = np.zeros([y_max + 1, x_max + 1, 10], dtype=np.float32)
+    view = grid.empty_view(10)
     if len(lidar) != 0:
-        indices = np.logical_and( np.logical_and(x_view >= 0, x_view <= x_max), 
-                              np.logical_and(y_view >= 0, y_view <= y_max)  )
-        
-        x_view = x_view[indices]
-        y_view = y_view[indices]
-        z = z[indices]
-        d = d[indices]
-        
-        d_z = [[d[i], z[i]] for i in range(len(d))]
-
-        view[y_view, x_view, :2] = d_z
+        grid.scatter(view[:,:,:2], x_view, y_view, indices, np.stack((d, z), axis=-1))
         
-        encode_boxes = np.array([box_encoder(lidar[i], gt_box3d) for i in range(len(lidar))])
-        encode_boxes = encode_boxes[indices]
+        encode_boxes = box_encoder_batch(lidar, gt_box3d)
 
-        # box = np.zeros([y_max+1, x_max+1, 8],dtype=np.float32)
-        view[y_view, x_view, 2:] = encode_boxes
+        grid.scatter(view[:,:,2:], x_view, y_view, indices, encode_boxes)
         
     if angle_offset == 0:
         return view
     else:
-        pad = int(angle_offset*(x_max + 1)/360)
+        pad = int(angle_offset*grid.width/360)
 
-        out = np.zeros([y_max+1, x_max+1+2*pad, 10],dtype=np.float32)
+        out = np.zeros([grid.height, grid.width+2*pad, 10],dtype=np.float32)
 
         #middle = int((x_max+1)/2)
         out[:,:pad,:] = view[:, -pad:,:]
-        out[:,pad:pad+x_max+1, :] = view
-        out[:, pad+x_max+1:x_max+1+2*pad, :] = view[:,:pad,:]
+        out[:,pad:pad+grid.width, :] = view
+        out[:, pad+grid.width:grid.width+2*pad, :] = view[:,:pad,:]
         return out
 
 
@@ -347,47 +434,20 @@ def fv_cylindrical_projection_for_test(lidar,
         lidar = lidar[lidar[:,2]>= -1.35]
         labels = []
 
-    x = lidar[:,0]
-    y = lidar[:,1]
-    z = lidar[:,2]
-    
-    d = np.sqrt(np.square(x)+np.square(y))
+    grid = panorama_grid(ver_fov, (-180., 180.), v_res, h_res)
+    x_view, y_view, indices, d, theta, phi = grid.project(lidar)
+    coord = np.stack((lidar[:,0], lidar[:,1], lidar[:,2], theta, phi, d), axis=-1)
     if not clustering:
         # remove near points
         lidar = lidar[d>=2]
 
-
-    theta = np.arctan2(-y, x)
-    phi = -np.arctan2(z, d)
-       
-    
-    x_view = np.int16(np.ceil((theta*180/np.pi + 180)/h_res))
-    y_view = np.int16(np.ceil((phi*180/np.pi + ver_fov[1])/v_res))
-    
-    x_max = np.int16(np.ceil(360/h_res))
-    y_max = np.int16(np.ceil((ver_fov[1] - ver_fov[0])/v_res))
-    
-    view = np.zeros([y_max+1, x_max+1, 6],dtype=np.float32)
+    view = grid.empty_view(6)
     if len(lidar) == 0:
         return view, lidar, labels
 
+    # the six channels are stacked as columns and scattered in one assignment
+    grid.scatter(view, x_view, y_view, indices, coord)
 
-    indices = np.logical_and( np.logical_and(x_view >= 0, x_view <= x_max), 
-                          np.logical_and(y_view >= 0, y_view <= y_max)  )
-    
-    x_view = x_view[indices]
-    y_view = y_view[indices]
-    x = x[indices]
-    y = y[indices]
-    z = z[indices]
-    d = d[indices]
-    
-    theta = theta[indices]
-    phi = phi[indices]
-    coord = [[x[i],y[i],z[i],theta[i],phi[i],d[i]] for i in range(len(x))]
-    
-    view[y_view,x_view] = coord
-    
     return view, lidar, labels
 # Can be deletted
 def list_of_paths(lidar_dir, gt_box_dir):
@@ -469,16 +529,153 @@ def correct_z_coord(gt_box, min_z = -1.5):
     return out 
 
 
-def convert(i):
-    lidar = np.load(list_of_lidar[i])
-    gt_box = np.load(list_of_gtbox[i])
-    
+def view_output_path(view_file):
+    if SPARSE_VIEWS:
+        return os.path.splitext(view_file)[0] + SPARSE_EXT
+    return view_file
+
+
+def save_view(path, view):
+    if SPARSE_VIEWS:
+        save_sparse_view(path, view)
+    else:
+        np.save(path, view)
+
+
+def project_frame(lidar_file, gtbox_file):
+    lidar = np.load(lidar_file)
+    gt_box = np.load(gtbox_file)
+
     correct_gtbox = correct_z_coord(gt_box)
-        
-    view = fv_cylindrical_projection_for_train(lidar, correct_gtbox)
-    np.save(list_of_view[i], view)
 
-    return i
+    return fv_cylindrical_projection_for_train(lidar, correct_gtbox, **PROJECTION_PARAMS)
+
+
+def remove_view(view_file, keep=None):
+    '''
+    remove the dense and sparse files of a view, except keep
+    '''
+    stem = os.path.splitext(view_file)[0]
+    for path in (stem + '.npy', stem + SPARSE_EXT):
+        if path != keep and os.path.lexists(path):
+            os.remove(path)
+
+
+def remove_stale_views(all_views, list_of_view):
+    '''
+    remove the views of the frames of all_views that are not converted any more (bad frames), and the
+    file of the other format (dense or sparse) left next to the converted views of list_of_view
+    '''
+    converted = set(list_of_view)
+    for view_file in all_views:
+        if view_file not in converted:
+            remove_view(view_file)
+        elif os.path.exists(view_output_path(view_file)):
+            remove_view(view_file, keep=view_output_path(view_file))
+
+
+def link_view(cached, output):
+    if os.path.lexists(output):
+        os.remove(output)
+    os.symlink(os.path.abspath(cached), output)
+
+
+def convert_frame(task):
+    '''
+    task : (lidar file, gt box file, view file)
+    With a view cache the view is taken from the cache, or converted and added to it, and the
+    view file links to it.
+    return : view file and None, or the traceback of the failure (the frame is skipped)
+    '''
+    lidar_file, gtbox_file, view_file = task
+    output = view_output_path(view_file)
+    try:
+        if view_cache_dir is None:
+            save_view(output, project_frame(lidar_file, gtbox_file))
+        else:
+            cache = ViewCache(view_cache_dir, PROJECTION_PARAMS, os.path.splitext(output)[1])
+            key = cache.key(lidar_file, gtbox_file)
+            cached = cache.path(key)
+            if not os.path.exists(cached):
+                cached = cache.store(key, save_view, project_frame(lidar_file, gtbox_file))
+            link_view(cached, output)
+        remove_view(view_file, keep=output)
+    except Exception:
+        return view_file, traceback.format_exc()
+    return view_file, None
+
+
+def params_since(view_dir, params):
+    '''
+    time from which the views of view_dir are converted with params, recorded in PARAMS_FILE
+    next to view_dir. When the parameters differ from the recorded ones they are recorded from now on.
+    '''
+    params_file = os.path.join(os.path.dirname(os.path.normpath(view_dir)), PARAMS_FILE)
+    params = json.loads(json.dumps(params))
+    if os.path.exists(params_file):
+        with open(params_file) as f:
+            recorded = json.load(f)
+        if recorded['params'] == params:
+            return recorded['since']
+    since = time.time()
+    with open(params_file, 'w') as f:
+        json.dump({'params': params, 'since': since}, f)
+    return since
+
+
+def outdated_tasks(list_of_lidar, list_of_gtbox, list_of_view, params=PROJECTION_PARAMS):
+    '''
+    (lidar, gt box, view) of the frames whose view is missing, older than its lidar or gt box,
+    or converted with other parameters
+    '''
+    since = {}
+    tasks = []
+    for task in zip(list_of_lidar, list_of_gtbox, list_of_view):
+        view_dir = os.path.dirname(task[2])
+        if view_dir not in since:
+            since[view_dir] = params_since(view_dir, params)
+        output = view_output_path(task[2])
+        if os.path.exists(output) and \
+                os.lstat(output).st_mtime >= max(os.path.getmtime(task[0]), os.path.getmtime(task[1]), since[view_dir]):
+            continue
+        tasks.append(task)
+    return tasks
+
+
+def convert_views(tasks, num_pool=None, log_file=None, report_every=100):
+    '''
+    convert the frames of tasks (see convert_frame), on num_pool processes (one per core when None)
+    streaming the tasks in chunks. The failures are written to log_file and do not stop the others.
+    return : number of failed frames
+    '''
+    if num_pool is None:
+        num_pool = cpu_count()
+    if num_pool > 1:
+        pool = Pool(num_pool)
+        chunksize = max(1, min(64, len(tasks) // (4*num_pool)))
+        results = pool.imap_unordered(convert_frame, tasks, chunksize)
+    else:
+        pool = None
+        results = (convert_frame(task) for task in tasks)
+
+    failed = 0
+    log = open(log_file, 'a') if log_file else None
+    try:
+        for done, (view_file, error) in enumerate(results, 1):
+            if error is not None:
+                failed += 1
+                if log:
+                    log.write('{0}\n{1}\n'.format(view_file, error))
+                    log.flush()
+            if done % report_every == 0 or done == len(tasks):
+                print('Finished {0} over {1} frames, {2} failed'.format(done, len(tasks), failed))
+    finally:
+        if log:
+            log.close()
+        if pool is not None:
+            pool.close()
+            pool.join()
+    return failed
 
 if __name__ == '__main__':
 
@@ -488,17 +685,18 @@ if __name__ == '__main__':
     list_of_lidar, list_of_gtbox, list_of_view = list_of_training_files(lidar_dir, gt_box_dir, list_bad_frames, 
                                                                     remove_bad_frames=True)
 
-    # Adjust num_pool = num of cores in the cpu 
-    num_pool = 8
-    print('Start converting {} frames'.format(len(list_of_lidar)) )
-    if using_pool:
-        p = Pool(num_pool)
-        p.map(convert, np.arange(len(list_of_lidar)))
+    # training lists the view files of the bags
+    _, _, all_views = list_of_training_files(lidar_dir, gt_box_dir, list_bad_frames, remove_bad_frames=False)
+    remove_stale_views(all_views, list_of_view)
 
-    else:
-        for i in range(len(list_of_lidar)):
-            convert(i)
-            if (i+1) % 100 == 0:
-                print('Finished {0} over {1} frames'.format(i+1, len(list_of_lidar)))
+    # frames already converted with the current parameters are skipped
+    tasks = outdated_tasks(list_of_lidar, list_of_gtbox, list_of_view)
+    print('Start converting {0} frames, {1} up to date'.format(len(tasks), len(list_of_lidar) - len(tasks)))
+
+    # one process per core
+    num_pool = cpu_count() if using_pool else 1
+    failed = convert_views(tasks, num_pool, failure_log)
+    if failed > 0:
+        print('{0} frames failed, see {1}'.format(failed, failure_log))
 
     print('Done converting - total time = {0}'.format(time.time() - start))
@@ -0,0 +1,154 @@
+#!/usr/bin/env python
+import argparse
+import glob
+import os
+import re
+import resource
+import time
+
+import numpy as np
+
+from dl_filter import dl_filter
+from dl_pipeline import *
+from stage_timer import StageTimer
+from model_warmup import warm_up, cold_start_report
+
+STAGES = ('decode', 'projection', 'predict', 'threshold', 'box_clustering', 'correction', 'filter')
+FRAME_PERIOD = 0.1 # sec, spacing of the frames whose file name carries no timestamp
+SEG_THRES = 0.3 # as in dl_tracker
+
+
+class StubModel(object):
+    '''
+    Stands in for the trained model, so that the pipeline runs without weights.
+    Takes the (N, 16, 320, 2) input of the model and returns its (N, 16, 320, 8) output,
+    random with about positive_rate of the pixels above the threshold.
+    '''
+
+    def __init__(self, positive_rate=0.01, seed=0):
+        self.positive_rate = positive_rate
+        self.random = np.random.RandomState(seed)
+
+    def predict(self, view, batch_size=None):
+        shape = view.shape[:3]
+        pred = np.empty(shape + (8,), dtype=np.float32)
+        pred[..., 0] = self.random.uniform(size=shape) < self.positive_rate
+        pred[..., 1:7] = self.random.normal(scale=2., size=shape + (6,))
+        pred[..., 7] = self.random.uniform(-np.pi, np.pi, size=shape)
+        return pred
+
+
+def load_trained_model(path):
+    if path.endswith('.pb'):
+        from frozen_model import FrozenModel
+        return FrozenModel(path)
+    if path.endswith('.tflite'):
+        from quantized_model import TFLiteModel
+        return TFLiteModel(path)
+    from keras.models import load_model
+    from full_view_train import my_loss
+    return load_model(path, custom_objects={'my_loss': my_loss})
+
+
+def list_frames(path):
+    '''
+    path : a directory of .npy frames (sorted by name) or a single .npy frame
+    return : list of (ts_sec, ts_nsec, file), the timestamp is read from names sec_nsec.npy
+             (as saved by dl_tracker ~dump_dir) and spaced by FRAME_PERIOD otherwise
+    '''
+    files = sorted(glob.glob(os.path.join(path, '*.npy'))) if os.path.isdir(path) else [path]
+    frames = []
+    for i, f in enumerate(files):
+        match = re.match(r'^(\d+)_(\d+)\.npy$', os.path.basename(f))
+        if match:
+            ts_sec, ts_nsec = int(match.group(1)), int(match.group(2))
+        else:
+            ts = int(round(i * FRAME_PERIOD * 1e9))
+            ts_sec, ts_nsec = ts // 1000000000, ts % 1000000000
+        frames.append((ts_sec, ts_nsec, f))
+    return frames
+
+
+def repeat_frames(frames, repeat):
+    '''
+    frames played repeat times, the timestamps of every pass follow the previous pass
+    '''
+    if len(frames) == 0:
+        return frames
+    first = frames[0][0] * 1000000000 + frames[0][1]
+    last = frames[-1][0] * 1000000000 + frames[-1][1]
+    span = last - first + int(round(FRAME_PERIOD * 1e9))
+    out = []
+    for k in range(repeat):
+        for ts_sec, ts_nsec, array in frames:
+            ts = ts_sec * 1000000000 + ts_nsec + k * span
+            out.append((ts // 1000000000, ts % 1000000000, array))
+    return out
+
+
+def run(frames, model, raw_lidar=False, seg_thres=SEG_THRES, timer=None):
+    '''
+    drive the dl_tracker pipeline (dl_pipeline) over the frames in process
+
+    frames : list of (ts_sec, ts_nsec, array), array holds /filtered_points rows
+             or a raw lidar frame when raw_lidar (clustered as point_filter does)
+    return : latency of every frame in sec
+    '''
+    if timer is None:
+        timer = StageTimer(window=len(frames))
+        timer.declare(*STAGES)
+    box_filter = dl_filter()
+
+    latencies = []
+    for ts_sec, ts_nsec, array in frames:
+        start = time.time()
+        with timer.stage('decode'):
+            rows = filtered_points_from_lidar(array) if raw_lidar else array
+            cluster_xy, lidar_with_idx = split_filtered_points(rows)
+        with timer.stage('projection'):
+            test_view, _, _ = fv_cylindrical_projection_for_test(lidar_with_idx, clustering=False)
+        box = predict_and_correct_view(model, test_view, lidar_with_idx, cluster_xy,
+                                       seg_thres=seg_thres, timer=timer)
+        with timer.stage('filter'):
+            box = filter_box(box_filter, box, ts_sec, ts_nsec)
+        latencies.append(time.time() - start)
+    return latencies
+
+
+def report(latencies, elapsed, timer):
+    latencies = np.array(latencies)
+    print('frames: {0}, throughput: {1:.1f} frames/s'.format(len(latencies), len(latencies) / elapsed))
+    print('latency ms - p50: {0:.2f}, p95: {1:.2f}, p99: {2:.2f}, max: {3:.2f}'.format(
+        *(np.percentile(latencies, [50, 95, 99, 100]) * 1000.)))
+    for name, count, values in timer.summary():
+        print('  {0:<15s} p50: {1:8.2f}  p95: {2:8.2f}  p99: {3:8.2f}'.format(
+            name, *[v * 1000. for v in values]))
+    # ru_maxrss is in KB on linux
+    print('peak memory: {0:.1f} MB'.format(resource.getrusage(resource.RUSAGE_SELF).ru_maxrss / 1024.))
+
+
+if __name__ == '__main__':
+    parser = argparse.ArgumentParser(description='offline benchmark of the dl_tracker pipeline, without ROS')
+    parser.add_argument('frames', help='directory of .npy frames, or a single .npy frame')
+    parser.add_argument('--lidar', action='store_true',
+                        help='frames are raw lidar points instead of /filtered_points rows')
+    parser.add_argument('--model', default=None, help='trained .h5 model, or its frozen .pb or quantized .tflite export, a stub model is used when omitted')
+    parser.add_argument('--repeat', type=int, default=1, help='number of passes over the frames')
+    parser.add_argument('--csv', default=None, help='write the stage latencies to this csv')
+    args = parser.parse_args()
+
+    start = time.time()
+    model = load_trained_model(args.model) if args.model else StubModel()
+    load_time = time.time() - start
+    print('cold start: ' + cold_start_report(load_time, warm_up(model, MODEL_INPUT_SHAPE)))
+    # frames are loaded up front so that disk reads are not measured
+    frames = [(ts_sec, ts_nsec, np.load(f)) for ts_sec, ts_nsec, f in list_frames(args.frames)]
+    frames = repeat_frames(frames, args.repeat)
+
+    timer = StageTimer(window=len(frames))
+    timer.declare(*STAGES)
+    start = time.time()
+    latencies = run(frames, model, raw_lidar=args.lidar, timer=timer)
+    report(latencies, time.time() - start, timer)
+    if args.csv:
+        timer.dump_csv(args.csv)
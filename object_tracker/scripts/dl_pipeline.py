@@ -0,0 +1,324 @@
+# the pipeline of dl_tracker without ROS, shared with the offline benchmark (dl_benchmark.py)
+import numpy as np
+
+from sklearn.cluster import DBSCAN
+from scipy.spatial import ConvexHull
+
+from convert_to_full_view_panorama import fv_cylindrical_projection_for_test, cluster, rotation
+from stage_timer import NULL_TIMER
+
+PI = 3.14159265358979
+PI_2 = 1.570796326794895
+CAR_LABEL = 1
+MODEL_INPUT_SHAPE = (1, 16, 320, 2) # one full view of depth and height
+
+def split_filtered_points(rows):
+	'''
+	rows : float32 N*4 rows (x, y, z, label) of /filtered_points (see point_filter.cpp),
+	       the cluster table (label -1) comes first, followed by the points labelled with their cluster index
+	return : cluster_xy (views of rows, no copy), lidar_with_idx
+	'''
+	num_cluster = np.count_nonzero(rows[:,3] < 0)
+	return rows[:num_cluster, :2], rows[num_cluster:]
+
+def filtered_points_from_lidar(lidar):
+	'''
+	rows of /filtered_points built from a raw lidar frame (N*D, D>=3) with the grid clustering of point_filter,
+	the cluster centers are the centers of the cluster bounding boxes
+	'''
+	points, labels = cluster(lidar, method='grid')
+	if len(points) == 0:
+		return np.empty((0,4), dtype=np.float32)
+	uniq, idx = np.unique(labels, return_inverse=True)
+	order = np.argsort(idx, kind='mergesort')
+	starts = np.searchsorted(idx[order], np.arange(len(uniq)))
+	xy = points[order, :2]
+	center = (np.minimum.reduceat(xy, starts) + np.maximum.reduceat(xy, starts)) * 0.5
+
+	rows = np.empty((len(uniq) + len(points), 4), dtype=np.float32)
+	rows[:len(uniq), :2] = center
+	rows[:len(uniq), 2] = 0
+	rows[:len(uniq), 3] = -1
+	rows[len(uniq):, :3] = points[:, :3]
+	rows[len(uniq):, 3] = idx
+	return rows
+
+def filter_box(box_filter, box, ts_sec, ts_nsec):
+	'''
+	velocity filtering of the predicted box with a dl_filter,
+	the previous box advanced to ts is used when nothing was predicted
+	'''
+	if len(box) == 0:
+		box = box_filter.prev_box
+		if len(box) != 0:
+			adv = box_filter.advance(ts_sec, ts_nsec)
+			box[1] += adv[0]
+			box[2] += adv[1]
+	if  len(box) != 0:
+		vel = box_filter.calc_velocity(box, ts_sec, ts_nsec)
+		angle = box[7]
+		#angle += np.arctan2(vel[1], vel[0])
+		# print "vel: ", vel
+		# print "ori ang: ", box[7]
+		# print "add ang: ", np.arctan2(vel[1], vel[0])
+		# print "ang: ", angle
+		box[7] = normalize_angle(angle)
+	return box
+
+def rotation_v(theta, points):
+	v = np.sin(theta)
+	u = np.cos(theta)
+	out = np.copy(points)
+	out[:,[0]] = u*points[:,[0]] + v*points[:,[1]]
+	out[:,[1]] = -v*points[:,[0]] + u*points[:,[1]]
+	return out
+
+def distance(p,q):
+    return np.sqrt(np.sum(np.square(p-q)))
+
+def length(v):
+    return distance(v,0)
+
+def fit_box(lidar):
+    '''
+    minimum-area 2d box of shape (4,2) around the xy of the points.
+    A minimum-area box has a side along an edge of the convex hull (rotating calipers),
+    so only the orientations of the hull edges are evaluated, all of them at once.
+    '''
+    lidar_2d = lidar[:,:2]
+
+    center = (np.max(lidar_2d, axis = 0) + np.min(lidar_2d, axis = 0))/2
+    center = np.expand_dims(center,0)
+    lidar_2d = lidar_2d - center
+
+    hull = lidar_2d
+    if len(lidar_2d) >= 3:
+        # QJ joggles the input so that collinear and repeated points still give a hull
+        hull = lidar_2d[ConvexHull(lidar_2d, qhull_options = 'QJ').vertices]
+
+    # orientation of every hull edge, folded into [0, pi/2)
+    edges = np.roll(hull, -1, axis = 0) - hull
+    angles = np.mod(np.arctan2(edges[:,1], edges[:,0]), np.pi/2)
+
+    # hull rotated by every candidate angle, as rotation() does for one point
+    cos = np.cos(angles)[:,np.newaxis]
+    sin = np.sin(angles)[:,np.newaxis]
+    rotated_x = cos*hull[:,0] + sin*hull[:,1]
+    rotated_y = -sin*hull[:,0] + cos*hull[:,1]
+
+    min_x, max_x = np.min(rotated_x, axis = 1), np.max(rotated_x, axis = 1)
+    min_y, max_y = np.min(rotated_y, axis = 1), np.max(rotated_y, axis = 1)
+    areas = (max_x - min_x)*(max_y - min_y)
+
+    arg_min = np.argmin(areas)
+
+    rp = np.array([[min_x[arg_min], min_y[arg_min]], [max_x[arg_min], min_y[arg_min]],
+                   [max_x[arg_min], max_y[arg_min]], [min_x[arg_min], max_y[arg_min]]])
+
+    # rotate the corners back
+    cos, sin = cos[arg_min], sin[arg_min]
+    box_2d = np.stack((cos*rp[:,0] - sin*rp[:,1], sin*rp[:,0] + cos*rp[:,1]), axis = -1) + center
+
+    return box_2d
+
+def move_box(box, side):
+    '''
+    box: 2d box of shape (4,2)
+    side: array of shape (2,2)
+    '''
+
+    #print(box)
+    #print(side)
+    v_box = box[1] - box[0]
+    v_side = side[1] - side[0]
+    angle_offset = np.arctan2(v_side[1], v_side[0]) - np.arctan2(v_box[1], v_box[0])
+    #print(np.arctan2(v_side[1], v_side[0]), np.arctan2(v_box[1], v_box[0]))
+    #print(angle_offset)
+    
+    rot_box = np.array([rotation(-angle_offset, box[i] - box[0]) + box[0] for i in range(4)])
+    #print('rot_box')
+    #print(rot_box)
+    
+    pos_offset = side[0] - box[0]
+    correct_box = rot_box + np.expand_dims(pos_offset, axis = 0)
+     
+    return correct_box
+
+def to_box2d(box_info):
+	center = box_info[1:3]
+	w = box_info[4] * 0.5
+	h = box_info[5] * 0.5
+	r = box_info[7]
+	box = np.array([[-w,h],[-w,-h],[w,-h],[w,h]])
+	box = rotation_v(r, box) + np.expand_dims(center, axis=0)
+	return box
+
+def normalize_angle(angle):
+	while angle > PI:
+		angle -= PI
+	while angle < 0:
+		angle += PI
+	if angle < 0.002:
+		angle = 0
+	if angle > PI - 0.002:
+		angle = PI
+	return angle
+
+def move_box_info(box_info, box):
+	center = np.mean(box, axis=0)
+	miny_idx = np.argmin(box[:,1])
+	# wv = box[(miny_idx+1)%4] - box[miny_idx]
+	# hv = box[(miny_idx+2)%4] - box[(miny_idx+1)%4]
+	wv = box[2] - box[1]
+	hv = box[1] - box[0]
+	rz = normalize_angle(np.arctan2(wv[1], wv[0]))
+	width = length(wv)
+	height = length(hv)
+	# # find nearest new rz from the old rz
+	# rz_candidate = np.array([nrz, normalize_angle(nrz + PI_2), normalize_angle(nrz + PI), normalize_angle(nrz + 3*PI_2)])	
+	# orz = normalize_angle(box_info[7])
+	# rz = rz_candidate[np.argmin(np.abs(rz_candidate - orz))]
+	box_info[1] = center[0]
+	box_info[2] = center[1]
+	box_info[4] = width
+	box_info[5] = height
+	box_info[7] = rz
+	return box_info
+
+def correct_box_info(predbox_info, fitbox):
+    '''
+    box, fitbox: 2d box of shape (4,2)
+    Move box to the right position based on position of fitbox 
+    '''
+    predbox = to_box2d(predbox_info)
+    pred_sides = np.array([distance(predbox[0], predbox[1]), distance(predbox[1], predbox[2])])
+    min_pred_side = np.min(pred_sides)
+    min_pred_ind = np.argmin(pred_sides)
+    
+    fit_distances = np.array([length(fitbox[i]) for i in range(4)])  
+    min_fit_ind = np.argmin(fit_distances)
+    next_fit_ind = (min_fit_ind + 1)%4
+    prev_fit_ind = (min_fit_ind + 3)%4
+    
+    next_fit_side = distance(fitbox[min_fit_ind],fitbox[next_fit_ind])
+    prev_fit_side = distance(fitbox[min_fit_ind],fitbox[prev_fit_ind])
+    
+    nearest_fit_point = fitbox[min_fit_ind]
+    
+    diff_next_side = abs(next_fit_side - min_pred_side)
+    diff_prev_side = abs(prev_fit_side - min_pred_side)
+    if diff_next_side < diff_prev_side:
+        side = fitbox[[min_fit_ind, next_fit_ind],:]
+    else:
+        side = fitbox[[prev_fit_ind, min_fit_ind],:]
+    
+    indices = [(min_pred_ind + i)%4 for i in range(4)]
+    box = np.array([predbox[i] for i in indices])
+    box = move_box(box, side)
+    box_distances = np.array([length(box[i]) for i in range(4)])
+    min_ind = np.argmin(box_distances)
+    if min_ind == min_fit_ind:
+    	moved_info = move_box_info(predbox_info, box)
+        return moved_info
+    else:
+        indices = [(min_pred_ind + i + 2)%4 for i in range(4)]
+        box = np.array([predbox[i] for i in indices])
+        box = move_box(box, side)
+        moved_info = move_box_info(predbox_info, box)
+        return moved_info
+  
+def correct_predicted_box(box_info, lidar_with_idx, cluster_xy):
+    nb_clusters = len(cluster_xy)
+    if nb_clusters == 0:
+        return box_info
+    else:
+        box_xy = box_info[1:3]
+    	distances = [distance(box_xy, cluster_xy[i]) for i in range(nb_clusters)]
+    	ind = np.argmin(distances)
+    	cluster_points = lidar_with_idx[lidar_with_idx[:,3] == ind]
+    	if (len(cluster_points) == 0):
+    		return box_info
+    	fitbox = fit_box(cluster_points)
+    	correctbox = correct_box_info(box_info, fitbox)
+    	return correctbox
+
+def one_box_clustering(boxes, eps = 1, min_samples = 1):
+    # Extract the center from predicted boxes
+    box_centers = boxes[:,1:4]
+    # Do clustering
+    db = DBSCAN(eps=eps, min_samples=min_samples).fit(box_centers)
+    labels = db.labels_
+       
+    n_clusters = len(set(labels))
+    n_points = [np.sum([labels == i]) for i in range(n_clusters) ]
+    max_point_cluster = np.argmax(n_points)
+    
+    index = (labels == max_point_cluster)
+    box = np.mean(boxes[index],axis = 0)
+    return box
+
+def predict_and_correct(model, lidar_with_idx, cluster_xy, clusterPoint=True, seg_thres=0.5):
+    
+	test_view, _, _ =  fv_cylindrical_projection_for_test(lidar_with_idx, clustering=clusterPoint)
+
+	return predict_and_correct_view(model, test_view, lidar_with_idx, cluster_xy, seg_thres)
+
+def predict_and_correct_view(model, test_view, lidar_with_idx, cluster_xy, seg_thres=0.5, timer=NULL_TIMER):
+	'''
+	predict_and_correct on an already projected test_view (see fv_cylindrical_projection_for_test)
+	timer : StageTimer receiving the predict, threshold, box_clustering and correction stages
+	'''
+	view = test_view[:,:,[5,2]].reshape(MODEL_INPUT_SHAPE)
+
+	test_view_reshape = test_view.reshape(-1,6)
+	with timer.stage('predict'):
+		pred = model.predict(view)
+	pred = pred[0].reshape(-1,8)
+
+	with timer.stage('threshold'):
+		boxes = decode_view_boxes(test_view_reshape, pred, seg_thres)
+	if len(boxes) == 0:
+		return np.array([])
+
+	with timer.stage('box_clustering'):
+		one_box = one_box_clustering(boxes)
+	with timer.stage('correction'):
+		one_box_info = correct_predicted_box(one_box, lidar_with_idx, cluster_xy)
+	return one_box_info
+
+def decode_view_boxes(test_view_reshape, pred, seg_thres):
+	'''
+	boxes [label, x, y, z, width, height, depth, rz] of the pixels predicted above seg_thres
+	'''
+	thres_pred = pred[pred[:,0] > seg_thres]
+	thres_view = test_view_reshape[pred[:,0] > seg_thres]
+
+	num_boxes = len(thres_pred)
+	boxes = np.zeros((num_boxes,8))
+	if num_boxes == 0:
+		return boxes
+
+	theta = thres_view[:,[3]]
+	phi = thres_pred[:,[-1]]
+
+	min = thres_view[:,:3] - rotation_v(theta, thres_pred[:,1:4]) # 0: left top
+	max = thres_view[:,:3] - rotation_v(theta, thres_pred[:,4:7]) # 6: right bottom
+	center = (min + max) * 0.5
+	dvec = max - min
+	sinphi = np.sin(phi)
+	cosphi = np.cos(phi)
+	normdxy = np.linalg.norm(dvec[:,:2], axis=1) # distance between 0 and 2
+	normdxy = normdxy.reshape(-1, 1)
+	width = normdxy * abs(sinphi)
+	height = normdxy * abs(cosphi)
+	depth = dvec[:,[2]]
+	ax = np.arctan2(dvec[:,[1]], dvec[:,[0]]) # angle from x axis to vector 2-0
+	rz = [0.5 * PI - phi[i] + ax[i] for i in range(len(ax))]
+
+	boxes[:,[0]] = CAR_LABEL
+	boxes[:,1:4] = center
+	boxes[:,[4]] = width
+	boxes[:,[5]] = height
+	boxes[:,[6]] = depth
+	boxes[:,[7]] = rz
+	return boxes
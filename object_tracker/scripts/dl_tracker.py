@@ -2,6 +2,7 @@
 import sys
 import os
 import time
+import threading
 import rospy as rp
 import numpy as np
 import math
@@ -11,11 +12,9 @@ import tf.transformations as transformer
 
 from sensor_msgs.msg import PointCloud2, PointField
 import sensor_msgs.point_cloud2 as pc2
-from std_msgs.msg import Float32MultiArray, Float64MultiArray, MultiArrayDimension
+from std_msgs.msg import Float32MultiArray, Float64MultiArray, Int32MultiArray, MultiArrayDimension
 from visualization_msgs.msg import Marker, MarkerArray
 
-from sklearn.cluster import DBSCAN
-
 import tensorflow
 import keras
 from keras.models import load_model
@@ -25,37 +24,66 @@ from full_view_model import fcn_model
 from full_view_train import *
 from convert_to_full_view_panorama import *
 from dl_filter import dl_filter
+from frame_mailbox import FrameMailbox
+from stage_timer import StageTimer
+from model_warmup import warm_up, cold_start_report
+from frozen_model import FrozenModel
+from quantized_model import TFLiteModel
+from dl_pipeline import *
 
 from keras.utils.generic_utils import get_custom_objects
 get_custom_objects().update({"my_loss": my_loss})
 
-PI = 3.14159265358979
-PI_2 = 1.570796326794895
 MAX_MARKER_COUNT = 30
 PUBLISH_MARKERS = True
-CAR_LABEL = 1
+LATE_TIME = 0.1 # sec, a frame published later than this after its arrival is late
+STAGES = ('decode', 'projection', 'predict', 'threshold', 'box_clustering', 'correction', 'filter', 'publish')
+LATENCY_PUBLISH_PERIOD = 10 # frames between two publications of the stage latencies
+BACKENDS = ('auto', 'keras', 'frozen', 'tflite')
 
 class dl_tracker:
 
-	def __init__(self):
+	def __init__(self, backend='auto', dump_dir=''):
 		# model
 		dir_path = os.path.dirname(os.path.realpath(__file__))
-		#self.model = load_model(os.path.join(dir_path, '../model/fv_model_for_car_June_30_132_63.h5'))
-		self.model = load_model(os.path.join(dir_path, '../model/fv_July_02_057.h5'))
+		start = time.time()
+		#model_path = os.path.join(dir_path, '../model/fv_model_for_car_June_30_132_63.h5')
+		model_path = os.path.join(dir_path, '../model/fv_July_02_057.h5')
+		self.model = load_tracker_model(model_path, backend)
+		load_time = time.time() - start
 		# filter
 		self.filter = dl_filter()
 		# graph
 		self.graph = tensorflow.get_default_graph()
+		# warm up before subscribing, so that the first frames do not pay for the first predictions
+		with self.graph.as_default():
+			durations = warm_up(self.model, MODEL_INPUT_SHAPE)
+		rp.loginfo("dl_tracker: cold start - %s", cold_start_report(load_time, durations))
+		# frames are handed from the subscriber callback to the inference thread
+		self.mailbox = FrameMailbox()
+		self.processed_frames = 0
+		self.late_frames = 0
+		# latency of every stage
+		self.timer = StageTimer()
+		self.timer.declare(*STAGES)
+		# directory where the received /filtered_points are saved for dl_benchmark, nothing saved if empty
+		self.dump_dir = dump_dir
 		# communication
 		self.initialize_communication()
-		rp.loginfo("dl_tracker: initialized")
-		print "dl_tracker: initialized"
+		# inference thread
+		self.worker = threading.Thread(target=self.run_inference)
+		self.worker.daemon = True
+		self.worker.start()
+		rp.loginfo("dl_tracker: initialized, ready")
+		print "dl_tracker: initialized, ready"
 
 	def initialize_communication(self):
-		self.subscriber = rp.Subscriber("/filtered_points", Float64MultiArray, self.on_points_received, queue_size=1)
+		self.subscriber = rp.Subscriber("/filtered_points", PointCloud2, self.on_points_received, queue_size=1)
 		self.detected_marker_publisher = rp.Publisher("/tracker/markers/detect", MarkerArray, queue_size=1)
 		self.predicted_marker_publisher = rp.Publisher("/tracker/markers/predict", MarkerArray, queue_size=1)
 		self.box_publisher = rp.Publisher("/tracker/boxes", Float32MultiArray, queue_size=1)
+		self.stats_publisher = rp.Publisher("/tracker/frame_stats", Int32MultiArray, queue_size=1)
+		self.latency_publisher = rp.Publisher("/tracker/stage_latency", Float32MultiArray, queue_size=1)
 		self.detected_markers = MarkerArray()
 		self.predicted_markers = MarkerArray()
 		for i in range(MAX_MARKER_COUNT):
@@ -102,54 +130,85 @@ class dl_tracker:
 			self.predicted_markers.markers.append(marker)
 
 	def on_points_received(self, data):
-		total_start = time.time()
-		ts_sec = int(data.data[0])
-		ts_nsec = int(data.data[1])
+		receive_time = time.time()
+		ts_sec = data.header.stamp.secs
+		ts_nsec = data.header.stamp.nsecs
+
+		with self.timer.stage('decode'):
+			# float32 rows (x, y, z, label), viewed in place: the cluster table (label -1) comes first,
+			# followed by the points labelled with their cluster index (see point_filter.cpp)
+			rows = np.frombuffer(data.data, dtype=np.float32).reshape(-1, 4)
+			cluster_xy, lidar_with_idx = split_filtered_points(rows)
+
+		if self.dump_dir:
+			np.save(os.path.join(self.dump_dir, '%d_%09d.npy' % (ts_sec, ts_nsec)), rows)
+
+		# project in the callback so that it overlaps with the prediction of the previous frame
+		with self.timer.stage('projection'):
+			test_view, _, _ = fv_cylindrical_projection_for_test(lidar_with_idx, clustering=False)
 
-		num_cluster = 0
-		cluster_xy = np.empty((0,2))
-		lidar_with_idx = np.empty((0,4))
+		# a frame still waiting for the inference thread is replaced
+		self.mailbox.put((receive_time, ts_sec, ts_nsec, lidar_with_idx, cluster_xy, test_view))
 
-		if (len(data.data) > 2):
-			num_cluster = int(data.data[2])
-			cluster_xy = np.array(data.data[3:3+2*num_cluster]).reshape(-1, 2)
-			lidar_with_idx = np.array(data.data[3+2*num_cluster:]).reshape(-1, 4)
+	def run_inference(self):
+		while not rp.is_shutdown():
+			frame = self.mailbox.take(timeout=0.5)
+			if frame is not None:
+				self.process_frame(*frame)
+
+	def process_frame(self, receive_time, ts_sec, ts_nsec, lidar_with_idx, cluster_xy, test_view):
 		box = np.empty((0,8))
 
 		# predict
 		with self.graph.as_default():
-			box = predict_and_correct(self.model, lidar_with_idx, cluster_xy, 
-				clusterPoint=False, seg_thres=0.3, nb_d=1)
+			box = predict_and_correct_view(self.model, test_view, lidar_with_idx, cluster_xy, 
+				seg_thres=0.3, timer=self.timer)
 
 		# filter by velocity
-		if len(box) == 0:
-			box = self.filter.prev_box
-			if len(box) != 0:
-				adv = self.filter.advance(ts_sec, ts_nsec)
-				box[1] += adv[0]
-				box[2] += adv[1]
-		if  len(box) != 0:
-			vel = self.filter.calc_velocity(box, ts_sec, ts_nsec)
-			angle = box[7]
-			#angle += np.arctan2(vel[1], vel[0])
-			# print "vel: ", vel
-			# print "ori ang: ", box[7]
-			# print "add ang: ", np.arctan2(vel[1], vel[0])
-			# print "ang: ", angle
-			box[7] = normalize_angle(angle)
+		with self.timer.stage('filter'):
+			box = filter_box(self.filter, box, ts_sec, ts_nsec)
 
 		# boxes = [box]
 		# boxes = self.filter.filter_by_velocity(boxes, ts_sec, ts_nsec)
 		# box = boxes[0]
 
-		if PUBLISH_MARKERS:
-			if box != None and len(box) > 0:			
-				self.publish_markers(box)
+		with self.timer.stage('publish'):
+			if PUBLISH_MARKERS:
+				if box != None and len(box) > 0:			
+					self.publish_markers(box)
+
+			if len(box) > 0:			
+				self.publish_detected_box(box)
+
+		total_time = time.time() - receive_time
+		self.processed_frames += 1
+		if total_time > LATE_TIME:
+			self.late_frames += 1
+		self.publish_frame_stats()
+		if self.processed_frames % LATENCY_PUBLISH_PERIOD == 0:
+			self.publish_stage_latency()
+
+		print ("total time: " + str(total_time))
 
-		if len(box) > 0:			
-			self.publish_detected_box(box)
+	def publish_frame_stats(self):
+		arr = Int32MultiArray()
+		# processed, dropped (replaced before inference) and late frames so far
+		arr.data = [self.processed_frames, self.mailbox.dropped, self.late_frames]
+		self.stats_publisher.publish(arr)
 
-		print ("total time: " + str(time.time() - total_start))
+	def publish_stage_latency(self):
+		summary = self.timer.summary()
+		arr = Float32MultiArray()
+		# one row per stage (in the order of the label) holding p50, p95 and p99 in ms
+		arr.layout.dim = [
+			MultiArrayDimension(label=",".join([name for name, _, _ in summary]), size=len(summary), stride=3*len(summary)),
+			MultiArrayDimension(label="p50,p95,p99", size=3, stride=3)]
+		arr.data = [v * 1000. for _, _, values in summary for v in values]
+		self.latency_publisher.publish(arr)
+
+	def dump_stage_latency(self, path):
+		self.timer.dump_csv(path)
+		rp.loginfo("dl_tracker: stage latencies written to %s", path)
 
 	def publish_detected_box(self, box_info):
 		arr = Float32MultiArray()
@@ -199,252 +258,40 @@ class dl_tracker:
 		self.predicted_marker_publisher.publish(self.predicted_markers)		
 		# rp.loginfo("dl_tracker: published %d markers", num_markers)
 
-def rotation_v(theta, points):
-	v = np.sin(theta)
-	u = np.cos(theta)
-	out = np.copy(points)
-	out[:,[0]] = u*points[:,[0]] + v*points[:,[1]]
-	out[:,[1]] = -v*points[:,[0]] + u*points[:,[1]]
-	return out
-
-def distance(p,q):
-    return np.sqrt(np.sum(np.square(p-q)))
-
-def length(v):
-    return distance(v,0)
-
-def rotate(angle, lidar):
-    return np.array([rotation(angle, lidar[i]) for i in range(len(lidar))])
-
-def fit_box(lidar, nb_d = 128):
-    
-    lidar_2d = lidar[:,:2]    
-    angle = np.pi/(nb_d*2)
-
-    center = (np.max(lidar_2d, axis = 0) + np.min(lidar_2d, axis = 0))/2
-    center = np.expand_dims(center,0)
-    #rotated
-    lidar_2d = lidar_2d - center
-    #rotated_lidar = [rotation_v(angle*i, lidar_2d) for i in range(nb_d)]
-    rotated_lidar = [rotate(angle*i, lidar_2d) for i in range(nb_d)]
-        
-    max_lidars = np.array([np.max(rotated_lidar[i],axis = 0) for i in range(nb_d)])
-    min_lidars = np.array([np.min(rotated_lidar[i],axis = 0) for i in range(nb_d)])
-    #print(max_lidars.shape, min_lidars.shape)
-    #max_lidars = np.max(rotated_lidar, axis = 1)
-    #min_lidars = np.min(rotated_lidar, axis = 1)
-    range_lidars = max_lidars - min_lidars
-    areas = range_lidars[:,0]*range_lidars[:,1]
-    #print(areas.shape)
-    
-    arg_min = np.argmin(areas)
-
-    rp0, rp2 = min_lidars[arg_min], max_lidars[arg_min]
-    rp1, rp3 = np.array([rp2[0], rp0[1]]), np.array([rp0[0], rp2[1]])
-    
-    #box_2d = rotation_v(-angle*arg_min, np.array([rp0,rp1,rp2,rp3])) + center
-    box_2d = np.array([rotation(-angle*arg_min, p) for p in [rp0,rp1,rp2,rp3]]) + center
-
-    return box_2d#, box
-
-def move_box(box, side):
-    '''
-    box: 2d box of shape (4,2)
-    side: array of shape (2,2)
-    '''
-
-    #print(box)
-    #print(side)
-    v_box = box[1] - box[0]
-    v_side = side[1] - side[0]
-    angle_offset = np.arctan2(v_side[1], v_side[0]) - np.arctan2(v_box[1], v_box[0])
-    #print(np.arctan2(v_side[1], v_side[0]), np.arctan2(v_box[1], v_box[0]))
-    #print(angle_offset)
-    
-    rot_box = np.array([rotation(-angle_offset, box[i] - box[0]) + box[0] for i in range(4)])
-    #print('rot_box')
-    #print(rot_box)
-    
-    pos_offset = side[0] - box[0]
-    correct_box = rot_box + np.expand_dims(pos_offset, axis = 0)
-     
-    return correct_box
-
-def to_box2d(box_info):
-	center = box_info[1:3]
-	w = box_info[4] * 0.5
-	h = box_info[5] * 0.5
-	r = box_info[7]
-	box = np.array([[-w,h],[-w,-h],[w,-h],[w,h]])
-	box = rotation_v(r, box) + np.expand_dims(center, axis=0)
-	return box
-
-def normalize_angle(angle):
-	while angle > PI:
-		angle -= PI
-	while angle < 0:
-		angle += PI
-	if angle < 0.002:
-		angle = 0
-	if angle > PI - 0.002:
-		angle = PI
-	return angle
-
-def move_box_info(box_info, box):
-	center = np.mean(box, axis=0)
-	miny_idx = np.argmin(box[:,1])
-	# wv = box[(miny_idx+1)%4] - box[miny_idx]
-	# hv = box[(miny_idx+2)%4] - box[(miny_idx+1)%4]
-	wv = box[2] - box[1]
-	hv = box[1] - box[0]
-	rz = normalize_angle(np.arctan2(wv[1], wv[0]))
-	width = length(wv)
-	height = length(hv)
-	# # find nearest new rz from the old rz
-	# rz_candidate = np.array([nrz, normalize_angle(nrz + PI_2), normalize_angle(nrz + PI), normalize_angle(nrz + 3*PI_2)])	
-	# orz = normalize_angle(box_info[7])
-	# rz = rz_candidate[np.argmin(np.abs(rz_candidate - orz))]
-	box_info[1] = center[0]
-	box_info[2] = center[1]
-	box_info[4] = width
-	box_info[5] = height
-	box_info[7] = rz
-	return box_info
-
-def correct_box_info(predbox_info, fitbox):
-    '''
-    box, fitbox: 2d box of shape (4,2)
-    Move box to the right position based on position of fitbox 
-    '''
-    predbox = to_box2d(predbox_info)
-    pred_sides = np.array([distance(predbox[0], predbox[1]), distance(predbox[1], predbox[2])])
-    min_pred_side = np.min(pred_sides)
-    min_pred_ind = np.argmin(pred_sides)
-    
-    fit_distances = np.array([length(fitbox[i]) for i in range(4)])  
-    min_fit_ind = np.argmin(fit_distances)
-    next_fit_ind = (min_fit_ind + 1)%4
-    prev_fit_ind = (min_fit_ind + 3)%4
-    
-    next_fit_side = distance(fitbox[min_fit_ind],fitbox[next_fit_ind])
-    prev_fit_side = distance(fitbox[min_fit_ind],fitbox[prev_fit_ind])
-    
-    nearest_fit_point = fitbox[min_fit_ind]
-    
-    diff_next_side = abs(next_fit_side - min_pred_side)
-    diff_prev_side = abs(prev_fit_side - min_pred_side)
-    if diff_next_side < diff_prev_side:
-        side = fitbox[[min_fit_ind, next_fit_ind],:]
-    else:
-        side = fitbox[[prev_fit_ind, min_fit_ind],:]
-    
-    indices = [(min_pred_ind + i)%4 for i in range(4)]
-    box = np.array([predbox[i] for i in indices])
-    box = move_box(box, side)
-    box_distances = np.array([length(box[i]) for i in range(4)])
-    min_ind = np.argmin(box_distances)
-    if min_ind == min_fit_ind:
-    	moved_info = move_box_info(predbox_info, box)
-        return moved_info
-    else:
-        indices = [(min_pred_ind + i + 2)%4 for i in range(4)]
-        box = np.array([predbox[i] for i in indices])
-        box = move_box(box, side)
-        moved_info = move_box_info(predbox_info, box)
-        return moved_info
-  
-def correct_predicted_box(box_info, lidar_with_idx, cluster_xy, nb_d=128):
-    nb_clusters = len(cluster_xy)
-    if nb_clusters == 0:
-        return box_info
-    else:
-        box_xy = box_info[1:3]
-    	distances = [distance(box_xy, cluster_xy[i]) for i in range(nb_clusters)]
-    	ind = np.argmin(distances)
-    	cluster_points = lidar_with_idx[lidar_with_idx[:,3] == ind]
-    	if (len(cluster_points) == 0):
-    		return box_info
-    	fitbox = fit_box(cluster_points, nb_d)
-    	correctbox = correct_box_info(box_info, fitbox)
-    	return correctbox
-
-def one_box_clustering(boxes, eps = 1, min_samples = 1):
-    # Extract the center from predicted boxes
-    box_centers = boxes[:,1:4]
-    # Do clustering
-    db = DBSCAN(eps=eps, min_samples=min_samples).fit(box_centers)
-    labels = db.labels_
-       
-    n_clusters = len(set(labels))
-    n_points = [np.sum([labels == i]) for i in range(n_clusters) ]
-    max_point_cluster = np.argmax(n_points)
-    
-    index = (labels == max_point_cluster)
-    box = np.mean(boxes[index],axis = 0)
-    return box
-
-def rotation_v(theta, points):
-	v = np.sin(theta)
-	u = np.cos(theta)
-	out = np.copy(points)
-	out[:,[0]] = u*points[:,[0]] + v*points[:,[1]]
-	out[:,[1]] = -v*points[:,[0]] + u*points[:,[1]]
-	return out
-
-def predict_and_correct(model, lidar_with_idx, cluster_xy, clusterPoint=True, seg_thres=0.5, nb_d=128):
-    
-	test_view, _, _ =  fv_cylindrical_projection_for_test(lidar_with_idx, clustering=clusterPoint)
-
-	view = test_view[:,:,[5,2]].reshape(1,16,320,2)
-
-	test_view_reshape = test_view.reshape(-1,6)
-	pred = model.predict(view)
-	pred = pred[0].reshape(-1,8)
-
-	thres_pred = pred[pred[:,0] > seg_thres]
-	thres_view = test_view_reshape[pred[:,0] > seg_thres]
-
-	num_boxes = len(thres_pred)
-	if num_boxes == 0:
-		return np.array([])
-	boxes = np.zeros((num_boxes,8))
-
-	theta = thres_view[:,[3]]
-	phi = thres_pred[:,[-1]]
-
-	min = thres_view[:,:3] - rotation_v(theta, thres_pred[:,1:4]) # 0: left top
-	max = thres_view[:,:3] - rotation_v(theta, thres_pred[:,4:7]) # 6: right bottom
-	center = (min + max) * 0.5
-	dvec = max - min
-	sinphi = np.sin(phi)
-	cosphi = np.cos(phi)
-	normdxy = np.linalg.norm(dvec[:,:2], axis=1) # distance between 0 and 2
-	normdxy = normdxy.reshape(-1, 1)
-	width = normdxy * abs(sinphi)
-	height = normdxy * abs(cosphi)
-	depth = dvec[:,[2]]
-	ax = np.arctan2(dvec[:,[1]], dvec[:,[0]]) # angle from x axis to vector 2-0
-	rz = [0.5 * PI - phi[i] + ax[i] for i in range(len(ax))]
-
-	boxes[:,[0]] = CAR_LABEL
-	boxes[:,1:4] = center
-	boxes[:,[4]] = width
-	boxes[:,[5]] = height
-	boxes[:,[6]] = depth
-	boxes[:,[7]] = rz
-
-	one_box = one_box_clustering(boxes)
-	one_box_info = correct_predicted_box(one_box, lidar_with_idx, cluster_xy, nb_d)
-	return one_box_info
+def load_tracker_model(model_path, backend='auto'):
+	'''
+	model_path : keras .h5 model, its frozen (.pb, see export_frozen_model.py) and
+	             quantized (.tflite, see quantized_model.py) exports are looked for next to it
+	backend : 'keras', 'frozen', 'tflite' or 'auto' (the frozen export when present, the keras model otherwise)
+	'''
+	assert backend in BACKENDS, "unknown inference backend"
+	frozen_path = os.path.splitext(model_path)[0] + '.pb'
+	if backend == 'auto':
+		backend = 'frozen' if os.path.exists(frozen_path) else 'keras'
+
+	if backend == 'frozen':
+		model = FrozenModel(frozen_path)
+	elif backend == 'tflite':
+		model = TFLiteModel(os.path.splitext(model_path)[0] + '.tflite')
+	else:
+		model = load_model(model_path)
+	rp.loginfo("dl_tracker: %s inference backend", backend)
+	return model
 
 def listen():
-	processor = dl_tracker()
 	# In ROS, nodes are uniquely named. If two nodes with the same
 	# node are launched, the previous one is kicked off. The
 	# anonymous=True flag means that rospy will choose a unique
 	# name for our 'listener' node so that multiple listeners can
 	# run simultaneously.
 	rp.init_node('dl_tracker', anonymous=True)
+	# the node is initialized first to read the backend parameter, and the dump directory
+	# (received points recorded for the offline benchmark) before the first frame arrives
+	processor = dl_tracker(rp.get_param('~backend', 'auto'), rp.get_param('~dump_dir', ''))
+	# optionally dump the stage latencies on shutdown
+	latency_csv = rp.get_param('~latency_csv', '')
+	if latency_csv:
+		rp.on_shutdown(lambda: processor.dump_stage_latency(latency_csv))
 	# spin() simply keeps python from exiting until this node is stopped
 	rp.spin()
 
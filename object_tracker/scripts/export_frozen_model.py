@@ -0,0 +1,202 @@
+#!/usr/bin/env python
+import argparse
+import glob
+import time
+
+import numpy as np
+import tensorflow as tf
+
+from frozen_model import FrozenModel, INPUT_NAME, OUTPUT_NAME
+from model_warmup import warm_up
+
+MAX_ABS_DIFF = 1e-3 # largest difference to the keras model accepted on the sample views
+
+_ACTIVATIONS = {
+    'linear': tf.identity,
+    'relu': tf.nn.relu,
+    'sigmoid': tf.sigmoid,
+    'tanh': tf.tanh,
+}
+
+
+def inbound_layer_names(layer):
+    nodes = getattr(layer, 'inbound_nodes', None) or getattr(layer, '_inbound_nodes')
+    inbound = nodes[0].inbound_layers
+    if not isinstance(inbound, (list, tuple)):
+        inbound = [inbound]
+    return [l.name for l in inbound]
+
+
+def layer_specs(model):
+    '''
+    (name, class name, inbound layer names, config, weights) of every layer of a keras model,
+    in topological order, the last layer is the output
+    '''
+    return [(layer.name, layer.__class__.__name__, inbound_layer_names(layer),
+             layer.get_config(), layer.get_weights()) for layer in model.layers]
+
+
+def batch_norm_affine(config, weights):
+    '''
+    per channel scale and shift applied by a batch normalization layer at inference
+    '''
+    weights = list(weights)
+    gamma = weights.pop(0) if config.get('scale', True) else 1.
+    beta = weights.pop(0) if config.get('center', True) else 0.
+    mean, var = weights
+    scale = gamma / np.sqrt(var + config['epsilon'])
+    return scale, beta - mean * scale
+
+
+def materialize(value):
+    '''
+    apply the scale and shift still pending on a tensor
+    '''
+    x, scale, shift = value
+    if scale is None:
+        return x
+    return x * scale.astype(np.float32) + shift.astype(np.float32)
+
+
+def conv_layer(kind, config, weights, x, scale=None, shift=None):
+    '''
+    Conv2D or Conv2DTranspose layer on x, with the pending batch normalization (scale, shift) of x
+    folded into it: the scale goes into the kernel, the shift into the bias. Near the zero padded
+    borders the shift does not reach every output, so its part of the bias is the convolution of an
+    image of ones with the kernel summed over the input channels, a constant the graph optimizer
+    computes once.
+    '''
+    assert tuple(config.get('dilation_rate', (1, 1))) == (1, 1), "dilated convolutions are not supported"
+    kernel = weights[0].astype(np.float32)
+    bias = weights[1].astype(np.float32) if config['use_bias'] else np.zeros(config['filters'], np.float32)
+    strides = (1,) + tuple(config['strides']) + (1,)
+    padding = config['padding'].upper()
+
+    def apply(inputs, kernel):
+        if kind == 'Conv2D':
+            return tf.nn.conv2d(inputs, kernel, strides, padding)
+        height, width = inputs.get_shape().as_list()[1:3]
+        if padding == 'SAME':
+            height, width = height * strides[1], width * strides[2]
+        else:
+            height = height * strides[1] + max(kernel.shape[0] - strides[1], 0)
+            width = width * strides[2] + max(kernel.shape[1] - strides[2], 0)
+        output_shape = tf.stack([tf.shape(inputs)[0], height, width, kernel.shape[2]])
+        return tf.nn.conv2d_transpose(inputs, kernel, output_shape, strides, padding)
+
+    if scale is None:
+        y = apply(x, kernel) + bias
+    else:
+        # input channels are on axis 2 of a Conv2D kernel and on axis 3 of a Conv2DTranspose kernel
+        in_axis = 2 if kind == 'Conv2D' else 3
+        scale_shape = [1, 1, 1, 1]
+        scale_shape[in_axis] = -1
+        folded = kernel * scale.reshape(scale_shape).astype(np.float32)
+        shift_kernel = np.expand_dims(np.tensordot(kernel, shift, axes=([in_axis], [0])), in_axis)
+        ones = tf.ones([1] + x.get_shape().as_list()[1:3] + [1])
+        y = apply(x, folded) + (apply(ones, shift_kernel.astype(np.float32)) + bias)
+    return _ACTIVATIONS[config['activation']](y)
+
+
+def build_folded_graph(specs, input_shape):
+    '''
+    inference graph of the layers (see layer_specs) with the batch normalizations folded
+    into the convolutions that follow them and the weights stored as constants
+
+    input_shape : (height, width, channels) of the input, the batch size is free
+    '''
+    graph = tf.Graph()
+    with graph.as_default():
+        # layer name -> (tensor, scale, shift), scale and shift pending on the tensor or None
+        tensors = {}
+        for name, kind, inbound, config, weights in specs:
+            if kind == 'InputLayer':
+                x = tf.placeholder(tf.float32, (None,) + tuple(input_shape), name=INPUT_NAME)
+                tensors[name] = (x, None, None)
+            elif kind == 'BatchNormalization':
+                x, scale, shift = tensors[inbound[0]]
+                bn_scale, bn_shift = batch_norm_affine(config, weights)
+                if scale is None:
+                    tensors[name] = (x, bn_scale, bn_shift)
+                else:
+                    tensors[name] = (x, scale * bn_scale, shift * bn_scale + bn_shift)
+            elif kind in ('Conv2D', 'Conv2DTranspose'):
+                x, scale, shift = tensors[inbound[0]]
+                tensors[name] = (conv_layer(kind, config, weights, x, scale, shift), None, None)
+            elif kind == 'MaxPooling2D':
+                x = materialize(tensors[inbound[0]])
+                pool = (1,) + tuple(config['pool_size']) + (1,)
+                strides = (1,) + tuple(config['strides']) + (1,)
+                tensors[name] = (tf.nn.max_pool(x, pool, strides, config['padding'].upper()), None, None)
+            elif kind == 'Concatenate':
+                xs = [materialize(tensors[n]) for n in inbound]
+                tensors[name] = (tf.concat(xs, axis=config['axis']), None, None)
+            else:
+                raise ValueError("cannot export layer {0} of type {1}".format(name, kind))
+
+        tf.identity(materialize(tensors[specs[-1][0]]), name=OUTPUT_NAME)
+    return graph
+
+
+def export(model, path):
+    '''
+    write the folded inference graph of a keras model to path (a binary GraphDef)
+    '''
+    graph = build_folded_graph(layer_specs(model), model.input_shape[1:])
+    with open(path, 'wb') as f:
+        f.write(graph.as_graph_def().SerializeToString())
+
+
+def load_views(pattern, input_shape):
+    '''
+    sample inputs of the model: views of shape (height, width, 6) as fed to dl_tracker (channels d, z)
+    or (height, width, 2), random views when no file matches
+    '''
+    views = []
+    for f in sorted(glob.glob(pattern)) if pattern else []:
+        view = np.load(f)
+        if view.shape[-1] == 6:
+            view = view[:, :, [5, 2]]
+        views.append(view[:input_shape[0], :input_shape[1]].astype(np.float32))
+    if len(views) == 0:
+        rng = np.random.RandomState(0)
+        views = [rng.uniform(0, 30, input_shape).astype(np.float32) for _ in range(8)]
+    return views
+
+
+def mean_predict_time(model, views):
+    warm_up(model, (1,) + views[0].shape)
+    start = time.time()
+    for view in views:
+        model.predict(view[np.newaxis])
+    return (time.time() - start) / len(views)
+
+
+if __name__ == '__main__':
+    parser = argparse.ArgumentParser(description='export a keras full view model to a frozen inference graph '
+                                                 'with the batch normalizations folded into the convolutions')
+    parser.add_argument('model', help='trained keras .h5 model')
+    parser.add_argument('output', help='frozen .pb graph to write')
+    parser.add_argument('--views', default=None, help='glob of sample view .npy files used for the check')
+    args = parser.parse_args()
+
+    from keras.models import load_model
+    from full_view_train import my_loss
+
+    start = time.time()
+    model = load_model(args.model, custom_objects={'my_loss': my_loss})
+    keras_load_time = time.time() - start
+    export(model, args.output)
+
+    start = time.time()
+    frozen = FrozenModel(args.output)
+    frozen_load_time = time.time() - start
+
+    views = load_views(args.views, model.input_shape[1:])
+    diff = max(np.max(np.abs(model.predict(v[np.newaxis]) - frozen.predict(v[np.newaxis]))) for v in views)
+    print('max abs difference on {0} views: {1:.2e}'.format(len(views), diff))
+    print('load time: keras {0:.2f} s, frozen {1:.2f} s'.format(keras_load_time, frozen_load_time))
+    print('predict time: keras {0:.1f} ms, frozen {1:.1f} ms'.format(
+        mean_predict_time(model, views) * 1000., mean_predict_time(frozen, views) * 1000.))
+    if diff > MAX_ABS_DIFF:
+        raise SystemExit('the frozen model differs from the keras model by {0:.2e}'.format(diff))
@@ -0,0 +1,38 @@
+import threading
+
+
+class FrameMailbox(object):
+    '''
+    Single slot mailbox between a producer and a consumer thread.
+    A new frame replaces the frame still waiting in the slot (latest frame wins),
+    the replaced frames are counted in dropped.
+    '''
+
+    def __init__(self):
+        self.cond = threading.Condition()
+        self.frame = None
+        self.dropped = 0
+
+    def put(self, frame):
+        '''
+        return : True if a waiting frame was replaced
+        '''
+        with self.cond:
+            replaced = self.frame is not None
+            if replaced:
+                self.dropped += 1
+            self.frame = frame
+            self.cond.notify()
+        return replaced
+
+    def take(self, timeout=None):
+        '''
+        wait for a frame and remove it from the slot
+        return : the frame, or None if no frame arrived within timeout
+        '''
+        with self.cond:
+            if self.frame is None:
+                self.cond.wait(timeout)
+            frame = self.frame
+            self.frame = None
+        return frame
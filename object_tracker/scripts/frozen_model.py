@@ -0,0 +1,27 @@
+import tensorflow as tf
+
+# names of the input and output tensors of an exported graph (see export_frozen_model.py)
+INPUT_NAME = 'input'
+OUTPUT_NAME = 'output'
+
+
+class FrozenModel(object):
+    '''
+    Inference-only model written by export_frozen_model.py: a graph holding its weights as constants,
+    run in its own session. predict() behaves as the one of the keras model it was exported from.
+    '''
+
+    def __init__(self, path):
+        graph_def = tf.GraphDef()
+        with open(path, 'rb') as f:
+            graph_def.ParseFromString(f.read())
+
+        self.graph = tf.Graph()
+        with self.graph.as_default():
+            tf.import_graph_def(graph_def, name='')
+        self.input = self.graph.get_tensor_by_name(INPUT_NAME + ':0')
+        self.output = self.graph.get_tensor_by_name(OUTPUT_NAME + ':0')
+        self.session = tf.Session(graph=self.graph)
+
+    def predict(self, x, batch_size=None):
+        return self.session.run(self.output, feed_dict={self.input: x})
@@ -0,0 +1,58 @@
+import os
+
+import numpy as np
+
+SPARSE_EXT = '.npz'
+
+
+def save_sparse_view(path, view):
+    '''
+    save a view (H*W*C) storing only its occupied pixels: their flat pixel index and their channel values.
+    A pixel is occupied when one of its channels is not zero, the other pixels are restored as zeros.
+    path : file name, SPARSE_EXT is appended if missing
+    '''
+    flat = view.reshape(-1, view.shape[-1])
+    index = np.flatnonzero(np.any(flat != 0, axis=1))
+    index = index.astype(np.uint16 if len(flat) <= np.iinfo(np.uint16).max + 1 else np.int32)
+    np.savez(path, shape=np.array(view.shape, dtype=np.int32), index=index, values=flat[index])
+
+
+def load_sparse_view(path, out=None):
+    '''
+    rehydrate a view saved by save_sparse_view
+    out : optional contiguous buffer of the view shape to fill in place
+    '''
+    with np.load(path) as data:
+        shape = tuple(data['shape'])
+        if out is None:
+            out = np.zeros(shape, dtype=data['values'].dtype)
+        else:
+            out.fill(0)
+        out.reshape(-1, shape[-1])[data['index']] = data['values']
+    return out
+
+
+def load_view(path):
+    '''
+    load a dense (.npy) or sparse (SPARSE_EXT) view
+    '''
+    if os.path.splitext(path)[1] == SPARSE_EXT:
+        return load_sparse_view(path)
+    return np.load(path)
+
+
+def unique_views(files):
+    '''
+    one file per view among files: when a view has both a dense (.npy) and a sparse (SPARSE_EXT) file,
+    the one written last
+    '''
+    stems = []
+    latest = {}
+    for f in files:
+        stem = os.path.splitext(f)[0]
+        if stem not in latest:
+            stems.append(stem)
+            latest[stem] = f
+        elif os.lstat(f).st_mtime > os.lstat(latest[stem]).st_mtime:
+            latest[stem] = f
+    return [latest[stem] for stem in stems]
@@ -0,0 +1,83 @@
+import csv
+import threading
+import time
+from collections import OrderedDict, deque
+from contextlib import contextmanager
+
+import numpy as np
+
+
+PERCENTILES = (50, 95, 99)
+
+
+class StageTimer(object):
+    '''
+    Rolling latency of named processing stages.
+    The last window durations of every stage are kept, stages may be timed from several threads.
+
+    window : number of durations kept per stage
+    enabled : when False, stage() does not measure anything
+    '''
+
+    def __init__(self, window=500, enabled=True):
+        self.window = window
+        self.enabled = enabled
+        self.lock = threading.Lock()
+        self.durations = OrderedDict()
+
+    def declare(self, *names):
+        '''
+        fix the order in which the stages are reported, before any of them is timed
+        '''
+        with self.lock:
+            for name in names:
+                if name not in self.durations:
+                    self.durations[name] = deque(maxlen=self.window)
+
+    def record(self, name, seconds):
+        with self.lock:
+            if name not in self.durations:
+                self.durations[name] = deque(maxlen=self.window)
+            self.durations[name].append(seconds)
+
+    @contextmanager
+    def stage(self, name):
+        '''
+        time the enclosed block as one run of the stage name
+        '''
+        if not self.enabled:
+            yield
+            return
+        start = time.time()
+        try:
+            yield
+        finally:
+            self.record(name, time.time() - start)
+
+    def summary(self, percentiles=PERCENTILES):
+        '''
+        return : list of (name, count, percentiles in sec) per stage, a stage never timed has nan percentiles
+        '''
+        with self.lock:
+            snapshot = [(name, list(d)) for name, d in self.durations.items()]
+        result = []
+        for name, d in snapshot:
+            if len(d) == 0:
+                result.append((name, 0, [float('nan')] * len(percentiles)))
+            else:
+                result.append((name, len(d), [float(v) for v in np.percentile(d, percentiles)]))
+        return result
+
+    def dump_csv(self, path, percentiles=PERCENTILES):
+        '''
+        write the summary to path, one row per stage with the percentiles in ms
+        '''
+        with open(path, 'w') as f:
+            writer = csv.writer(f)
+            writer.writerow(['stage', 'count'] + ['p%d_ms' % p for p in percentiles])
+            for name, count, values in self.summary(percentiles):
+                writer.writerow([name, count] + ['%.3f' % (v * 1000.) for v in values])
+
+
+# does not measure anything, default of the functions taking an optional timer
+NULL_TIMER = StageTimer(window=1, enabled=False)
@@ -0,0 +1,72 @@
+import hashlib
+import json
+import os
+
+CACHE_VERSION = 1 # bump when the conversion code changes, the views cached before are then ignored
+PARAMS_FILE = 'params.json'
+
+
+def params_key(params):
+    '''
+    hash of the conversion parameters, names the cache directory of a configuration
+    '''
+    text = json.dumps({'version': CACHE_VERSION, 'params': params}, sort_keys=True)
+    return hashlib.sha1(text.encode('utf-8')).hexdigest()[:16]
+
+
+def file_digest(path):
+    h = hashlib.sha1()
+    with open(path, 'rb') as f:
+        for block in iter(lambda: f.read(1 << 20), b''):
+            h.update(block)
+    return h.digest()
+
+
+class ViewCache(object):
+    '''
+    Content addressed store of converted views: a view is stored under the hash of the content of
+    its input files, in the directory of the hash of its conversion parameters. The views of several
+    configurations coexist, and a frame is converted once per configuration whatever its path.
+    Safe to share between processes: a view appears in the cache only once completely written.
+    '''
+
+    def __init__(self, cache_dir, params, ext='.npy'):
+        self.dir = os.path.join(cache_dir, params_key(params))
+        self.ext = ext
+        params_file = os.path.join(self.dir, PARAMS_FILE)
+        if not os.path.exists(params_file):
+            self._makedirs(self.dir)
+            # for the reader of the cache directory, the key does not depend on it
+            with open(params_file, 'w') as f:
+                json.dump({'version': CACHE_VERSION, 'params': params}, f, sort_keys=True)
+
+    @staticmethod
+    def _makedirs(path):
+        try:
+            os.makedirs(path)
+        except OSError:
+            # created meanwhile by another process
+            if not os.path.isdir(path):
+                raise
+
+    def key(self, *files):
+        h = hashlib.sha1()
+        for f in files:
+            h.update(file_digest(f))
+        return h.hexdigest()
+
+    def path(self, key):
+        return os.path.join(self.dir, key[:2], key + self.ext)
+
+    def store(self, key, save, view):
+        '''
+        write view with save(path, view) under key
+        return : path of the cached view
+        '''
+        path = self.path(key)
+        self._makedirs(os.path.dirname(path))
+        # the temporary file keeps the extension, numpy would append it otherwise
+        tmp = os.path.join(os.path.dirname(path), '.{0}.{1}{2}'.format(key, os.getpid(), self.ext))
+        save(tmp, view)
+        os.rename(tmp, path)
+        return path
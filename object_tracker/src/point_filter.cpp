@@ -2,8 +2,8 @@
 #include <object_tracker/cluster.h>
 
 #include <ros/ros.h>
-#include <std_msgs/Float64MultiArray.h>
 #include <sensor_msgs/PointCloud2.h>
+#include <sensor_msgs/PointField.h>
 #include <pcl/ModelCoefficients.h>
 #include <pcl/sample_consensus/method_types.h>
 #include <pcl/sample_consensus/model_types.h>
@@ -18,13 +18,19 @@ namespace TeamKR
 
 const float MAX_VALUE = 1000.0f;
 
+// /filtered_points layout : a PointCloud2 of float32 rows (x, y, z, label)
+// the first rows are the cluster table (center x, center y, 0, -1),
+// followed by the points of every cluster labelled with the cluster index
+const size_t ROW_SIZE = 4;
+const float CLUSTER_CENTER_LABEL = -1.0f;
+
 class PointFilter
 {
 public:
 	PointFilter(ros::NodeHandle n, const std::string& mode)
 	{
     	subscriber_ = n.subscribe("/velodyne_points", 1, &PointFilter::onPointsReceived, this);
-    	publisher_ = n.advertise<std_msgs::Float64MultiArray>("/filtered_points", 1);
+    	publisher_ = n.advertise<sensor_msgs::PointCloud2>("/filtered_points", 1);
     	
     	cloud_ = PCLPointCloud::Ptr(new PCLPointCloud());
     	filtered_ = PCLPointCloud::Ptr(new PCLPointCloud());
@@ -65,14 +71,6 @@ public:
 private:
 	void onPointsReceived(const sensor_msgs::PointCloud2::ConstPtr& msg)
 	{
-		std_msgs::Float64MultiArray output;
-
-		// add timestamp
-		int tsSec = msg->header.stamp.sec;
-		int tsNsec = msg->header.stamp.nsec;
-		output.data.push_back(tsSec);
-		output.data.push_back(tsNsec);
-
 		sensor_msgs::PointCloud2 response = *msg;
 		response.fields[3].name = "intensity";
 		pcl::fromROSMsg(response, *cloud_);
@@ -81,7 +79,7 @@ private:
 		if (pointCount == 0u)
 		{
 			// publish empty points
-			publisher_.publish(output);
+			publisher_.publish(prepare(msg->header, 0u, 0u));
 			return;
 		}
 
@@ -101,16 +99,29 @@ private:
 		if (clusterCount == 0u)
 		{
 			// publish empty points
-			publisher_.publish(output);
+			publisher_.publish(prepare(msg->header, 0u, 0u));
 			return;
 		}
 
 		std::list<Cluster*> filtered;
 		filterClusters(clusters, filtered, true);
 
-		int numCluster = 0;
-		std::vector<value_type> clusterX, clusterY;
-		std::vector<value_type> pointInfo;
+		size_t numCluster = 0u;
+		size_t numPoint = 0u;
+		for (std::list<Cluster*>::const_iterator cit = filtered.begin(); cit != filtered.end(); ++cit)
+		{
+			if ((*cit)->pointCount() != 0)
+			{
+				numCluster++;
+				numPoint += (*cit)->pclPoints().size();
+			}
+		}
+
+		// write the rows straight into the message buffer
+		sensor_msgs::PointCloud2& output = prepare(msg->header, numCluster, numPoint);
+		float* center = output.data.empty() ? NULL : reinterpret_cast<float*>(&output.data[0]);
+		float* point = center + numCluster * ROW_SIZE;
+		float clusterIndex = 0.0f;
 		for (std::list<Cluster*>::const_iterator cit = filtered.begin(); cit != filtered.end(); ++cit)
 		{
 			if ((*cit)->pointCount() == 0)
@@ -120,30 +131,18 @@ private:
 
 			for (PCLPointVector::const_iterator pit = (*cit)->pclPoints().begin(); pit != (*cit)->pclPoints().end(); ++pit)
 			{
-				pointInfo.push_back(pit->x);
-				pointInfo.push_back(pit->y);
-				pointInfo.push_back(pit->z);
-				pointInfo.push_back(numCluster);
+				*point++ = pit->x;
+				*point++ = pit->y;
+				*point++ = pit->z;
+				*point++ = clusterIndex;
 			}
 
-			clusterX.push_back((*cit)->center()[0]);
-			clusterY.push_back((*cit)->center()[1]);
+			*center++ = (*cit)->center()[0];
+			*center++ = (*cit)->center()[1];
+			*center++ = 0.0f;
+			*center++ = CLUSTER_CENTER_LABEL;
 
-			numCluster++;
-		}
-
-		output.data.push_back(numCluster);
-		std::vector<value_type>::const_iterator xit = clusterX.begin();
-		std::vector<value_type>::const_iterator yit = clusterY.begin();
-		for (; xit != clusterX.end(); ++xit)
-		{
-			output.data.push_back(*xit);
-			output.data.push_back(*yit);
-		}
-
-		for (std::vector<value_type>::const_iterator it = pointInfo.begin(); it != pointInfo.end(); ++it)
-		{
-			output.data.push_back(*it);
+			clusterIndex += 1.0f;
 		}
 
 		publisher_.publish(output);
@@ -155,6 +154,29 @@ private:
 		}
 	}
 
+	sensor_msgs::PointCloud2& prepare(const std_msgs::Header& header, size_t numCluster, size_t numPoint)
+	{
+		static const char* FIELD_NAMES[ROW_SIZE] = {"x", "y", "z", "label"};
+
+		output_.header = header;
+		output_.height = 1;
+		output_.width = numCluster + numPoint;
+		output_.fields.resize(ROW_SIZE);
+		for (size_t i = 0; i < ROW_SIZE; ++i)
+		{
+			output_.fields[i].name = FIELD_NAMES[i];
+			output_.fields[i].offset = i * sizeof(float);
+			output_.fields[i].datatype = sensor_msgs::PointField::FLOAT32;
+			output_.fields[i].count = 1;
+		}
+		output_.is_bigendian = false;
+		output_.point_step = ROW_SIZE * sizeof(float);
+		output_.row_step = output_.point_step * output_.width;
+		output_.is_dense = true;
+		output_.data.resize(output_.row_step);
+		return output_;
+	}
+
 	void markCar(const PCLPointVector& points, BitVector& filterBV) const
 	{
 		PCLPointVector::const_iterator pit = points.begin();
@@ -323,6 +345,7 @@ private:
 private:
 	ros::Subscriber subscriber_;
 	ros::Publisher publisher_;
+	sensor_msgs::PointCloud2 output_;
 	PCLPointCloud::Ptr cloud_;
 	PCLPointCloud::Ptr filtered_;
 	// cluster builder
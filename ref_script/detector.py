@@ -3,6 +3,7 @@ import sys
 import rospy as rp
 import numpy as np
 import math
+import time
 
 #import cv2
 #from cv_bridge import CvBridge, CvBridgeError
@@ -18,6 +19,10 @@ from keras.models import load_model
 from keras.optimizers import Adam
 
 from model import fcn_model, my_loss
+from panorama import project_segments
+from point_cloud import cloud_to_xyz
+from util_func import decode_corner_boxes
+from model_warmup import warm_up, cold_start_report
 
 from keras.utils.generic_utils import get_custom_objects
 #loss = SSD_Loss(neg_pos_ratio=neg_pos_ratio, alpha=alpha)
@@ -49,18 +54,24 @@ class detector:
 			self.hor_fov_arr.append([0.,90.])
 			self.hor_fov_arr.append([90.,180.])
 			self.h_res = 0.3515625
-		# input buffer
-		self.input_buf = np.zeros([self.y_max+1, self.x_max+1, 6], dtype=np.float32);
+		# input buffer, one view per horizontal segment
+		self.input_buf = np.zeros([self.num_hor_seg, self.y_max+1, self.x_max+1, 6], dtype=np.float32);
 		# model
 		dir_path = os.path.dirname(os.path.realpath(__file__))
+		start = time.time()
 		self.model = load_model(dir_path + '/../model/model.h5')
+		load_time = time.time() - start
 		self.graph = tf.get_default_graph()
+		# warm up with the segment batch before subscribing
+		with self.graph.as_default():
+			durations = warm_up(self.model, (self.num_hor_seg, self.y_max+1, self.x_max+1, 2))
+		rp.loginfo("Detector: cold start - %s", cold_start_report(load_time, durations))
 		self.seg_thres = 0.07
 		# communication
 		self.use_cpp_node = True if use_cpp_node == '1' else False
 		self.initialize_communication()
-		rp.loginfo("Detector: initialized")
-		print "Detector: initialized"
+		rp.loginfo("Detector: initialized, ready")
+		print "Detector: initialized, ready"
 
 	def initialize_communication(self):
 		self.subscriber = rp.Subscriber("/velodyne_points", PointCloud2, self.on_points_received, queue_size=1)
@@ -103,17 +114,11 @@ class detector:
 		self.process_locked = True
 		#rp.loginfo("Detector: process started")
 		# process points
-		x = []
-		y = []
-		z = []
-		for p in pc2.read_points(data, skip_nans=True):
-			x.append(p[0])
-			y.append(p[1])
-			z.append(p[2])
+		lidar = cloud_to_xyz(data, skip_nans=True)
 		box_info = np.empty((0,8))
 		# predict
 		with self.graph.as_default():
-			box_info = self.predict_boxes(x, y, z)
+			box_info = self.predict_boxes(lidar)
 		# publish
 		if self.use_cpp_node:
 			self.publish_detected_boxes(box_info)
@@ -156,80 +161,20 @@ class detector:
 		self.publisher.publish(self.marker_array)
 		rp.loginfo("Detector: published %d markers", num_markers)
 
-	def rotation(self, theta, points):
-		v = np.sin(theta)
-		u = np.cos(theta)
-		out = np.copy(points)
-		out[:,0] = u*points[:,0] + v*points[:,1]
-		out[:,1] = -v*points[:,0] + u*points[:,1]
-		return out
+	def predict_boxes(self, lidar):
+		# project all horizontal segments at once
+		project_segments(lidar, self.hor_fov_arr, self.ver_fov, self.v_res, self.h_res,
+			(self.y_max+1, self.x_max+1), out=self.input_buf)
+		cylindrical_views = self.input_buf[:,:,:,[5,2]]
 
-	def predict_boxes(self, x, y, z):
-		x = np.array(x)
-		y = np.array(y)
-		z = np.array(z)
-		d = np.sqrt(np.square(x)+np.square(y))
-		theta = np.arctan2(-y, x)
-		phi = -np.arctan2(z, d)
+		# predict all segments in a single batch
+		preds = self.model.predict(cylindrical_views, batch_size=self.num_hor_seg)
 
 		all_boxes = np.empty((0,8,3))
 
 		# repeat for horizontal segments
 		for ns in range(self.num_hor_seg):
-			self.input_buf.fill(0)
-
-			x_view = np.int16(np.ceil((theta*180/np.pi - self.hor_fov_arr[ns][0])/self.h_res))
-			y_view = np.int16(np.ceil((phi*180/np.pi + self.ver_fov[1])/self.v_res))
-
-			indices = np.logical_and( np.logical_and(x_view >= 0, x_view <= self.x_max), \
-				np.logical_and(y_view >= 0, y_view <= self.y_max) )
-
-			x_view = x_view[indices]
-			y_view = y_view[indices]
-			x_f = x[indices]
-			y_f = y[indices]
-			z_f = z[indices]
-			d_f = d[indices]
-			theta_f = theta[indices]
-			phi_f = phi[indices]
-
-			coord = [[x_f[i],y_f[i],z_f[i],theta_f[i],phi_f[i],d_f[i]] for i in range(len(x_f))]
-
-			self.input_buf[y_view,x_view] = coord
-			cylindrical_view = self.input_buf[:,:,[5,2]].reshape(1,64,256,2)
-
-			# predict
-			pred = self.model.predict(cylindrical_view)
-			pred = pred[0]
-			pred = pred.reshape(-1,8)
-			view = self.input_buf.reshape(-1,6)
-			pred_indices = pred[:,0] > self.seg_thres
-			thres_pred = pred[pred_indices]
-			thres_view = view[pred_indices]
-
-			num_boxes = len(thres_pred)
-			boxes = np.zeros((num_boxes,8,3))
-
-			# compose boxes
-			boxes[:,0] = thres_view[:,:3] - self.rotation(thres_view[:,3],thres_pred[:,1:4])
-			boxes[:,6] = thres_view[:,:3] - self.rotation(thres_view[:,3],thres_pred[:,4:7])
-			boxes[:,2,:2] = boxes[:,6,:2]
-			boxes[:,2,2] = boxes[:,0,2]
-
-			phi_pred = thres_pred[:,-1]
-			cos_phi = np.cos(phi_pred)
-			sin_phi = np.sin(phi_pred)
-			z_pred = boxes[:,2] - boxes[:,0]
-
-			boxes[:,1,0] = (cos_phi*z_pred[:,0] + sin_phi*z_pred[:,1])*cos_phi + boxes[:,0,0]
-			boxes[:,1,1] = (-sin_phi*z_pred[:,0] + cos_phi*z_pred[:,1])*cos_phi + boxes[:,0,1]
-			boxes[:,1,2] = boxes[:,0,2]
-
-			boxes[:,3] = boxes[:,0] + boxes[:,2] - boxes[:,1]
-			boxes[:,4] = boxes[:,0] + boxes[:,6] - boxes[:,2]
-			boxes[:,5] = boxes[:,1] + boxes[:,4] - boxes[:,0]
-			boxes[:,7] = boxes[:,4] + boxes[:,6] - boxes[:,5]
-
+			boxes = decode_corner_boxes(self.input_buf[ns], preds[ns], self.seg_thres)
 			all_boxes = np.vstack((all_boxes, boxes))
 
 		num_boxes = len(all_boxes)
@@ -0,0 +1,33 @@
+import time
+
+import numpy as np
+
+
+def warm_up(model, input_shape, runs=3):
+    '''
+    run dummy inputs of the production shape through a keras model before the first real frame,
+    so that the frames do not pay for building the predict function and selecting the kernels.
+    Call it inside the graph used for the predictions.
+
+    input_shape : full input shape including the batch size, e.g. (1, 16, 320, 2)
+    return : duration of every run in sec, the first one is the cold start
+    '''
+    if hasattr(model, '_make_predict_function'):
+        # build the predict function now, not lazily from the inference thread
+        model._make_predict_function()
+
+    dummy = np.zeros(input_shape, dtype=np.float32)
+    durations = []
+    for _ in range(runs):
+        start = time.time()
+        model.predict(dummy, batch_size=input_shape[0])
+        durations.append(time.time() - start)
+    return durations
+
+
+def cold_start_report(load_time, durations):
+    '''
+    one line summary of the model loading and of the warm-up runs (in sec)
+    '''
+    return 'load %.0f ms, first predict %.0f ms, warm predict %.1f ms' % (
+        load_time * 1000., durations[0] * 1000., min(durations) * 1000.)
@@ -0,0 +1,59 @@
+import numpy as np
+
+from sensor_msgs.msg import PointField
+
+
+# numpy type of every PointField datatype
+_FIELD_TYPES = {
+    PointField.INT8: 'i1',
+    PointField.UINT8: 'u1',
+    PointField.INT16: 'i2',
+    PointField.UINT16: 'u2',
+    PointField.INT32: 'i4',
+    PointField.UINT32: 'u4',
+    PointField.FLOAT32: 'f4',
+    PointField.FLOAT64: 'f8',
+}
+
+
+def cloud_dtype(cloud, field_names):
+    '''
+    structured numpy type of one point of a PointCloud2, holding only the requested fields
+    at their offsets, its itemsize is the point_step of the message
+    '''
+    byte_order = '>' if cloud.is_bigendian else '<'
+    fields = dict((f.name, f) for f in cloud.fields)
+    formats = [byte_order + _FIELD_TYPES[fields[name].datatype] for name in field_names]
+    offsets = [fields[name].offset for name in field_names]
+    return np.dtype({'names': list(field_names), 'formats': formats,
+                     'offsets': offsets, 'itemsize': cloud.point_step})
+
+
+def cloud_to_xyz(cloud, skip_nans=True):
+    '''
+    decode the x, y, z fields of a PointCloud2 with array operations,
+    the points are read straight from the message buffer using its offsets and point_step
+
+    cloud : sensor_msgs/PointCloud2
+    skip_nans : drop the points with a NaN coordinate
+
+    return : a float32 numpy array of shape N*3
+    '''
+    dtype = cloud_dtype(cloud, ('x', 'y', 'z'))
+    data = cloud.data
+    if isinstance(data, (list, tuple)):
+        data = bytearray(data)
+
+    # rows may be padded, keep only width points of each row
+    rows = np.frombuffer(data, dtype=np.uint8, count=cloud.row_step * cloud.height)
+    rows = rows.reshape(cloud.height, cloud.row_step)[:, :cloud.width * cloud.point_step]
+    points = np.ascontiguousarray(rows).view(dtype).reshape(-1)
+
+    lidar = np.empty((len(points), 3), dtype=np.float32)
+    lidar[:, 0] = points['x']
+    lidar[:, 1] = points['y']
+    lidar[:, 2] = points['z']
+
+    if skip_nans:
+        lidar = lidar[~np.isnan(lidar).any(axis=1)]
+    return lidar